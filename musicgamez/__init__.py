@@ -38,17 +38,20 @@ from flask_cachecontrol import FlaskCacheControl
 from flask_dance.consumer import OAuth2ConsumerBlueprint, OAuth2Session
 from flask_dance.consumer.storage import MemoryStorage
 from flask_sqlalchemy import SQLAlchemy
-from google_measurement_protocol import pageview
-from hashlib import md5
 from mbdata.models import ArtistAlias, ArtistAliasType, ArtistCreditName
 from mbdata.models import Recording, RecordingAlias, RecordingAliasType
+from musicgamez.analytics import Reporter, TRACKING_URI
+from musicgamez.cache import LRUCache
+from musicgamez.fingerprinting import FingerprintEngine, default_workers
+from musicgamez.httpclient import HTTPClient
+from musicgamez.metrics import Metrics
+from musicgamez.scoring import DEFAULT_WEIGHTS, DEFAULT_SITE_DURATION_WEIGHTS
 from oauthlib.oauth2 import BackendApplicationClient
 import os
 from sqlalchemy import orm, event
 from sqlalchemy.pool import NullPool
 from sqlalchemy.schema import MetaData
 import time
-from uuid import UUID
 from werkzeug.exceptions import HTTPException
 
 
@@ -58,6 +61,13 @@ scheduler = APScheduler(TwistedScheduler())
 babel = Babel()
 relationship_domain = Domain(domain="relationships")
 flask_cache_control = FlaskCacheControl()
+page_cache = LRUCache()
+genre_cloud_cache = LRUCache(1, 60*60)
+recording_cache = LRUCache()
+http_client = HTTPClient()
+reporter = Reporter(http_client)
+metrics = Metrics()
+fingerprint_engine = FingerprintEngine()
 
 
 class OAuth2SessionWithUserAgent(OAuth2Session):
@@ -65,6 +75,7 @@ class OAuth2SessionWithUserAgent(OAuth2Session):
         super(OAuth2SessionWithUserAgent, self).__init__(*args, **kwargs)
         from musicgamez import db
         self.headers["User-Agent"] = db.app.config["USER_AGENT"]
+        http_client.mount(self)
 
 
 class OAuth2ConsumerBlueprintWithLogout(OAuth2ConsumerBlueprint):
@@ -155,21 +166,77 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
         SCHEDULER_EXECUTORS={
-            # This is going to bite me later. Threads in Python are bound by the
-            # Global Interpreter Lock, which means threads can only be preempted
-            # during OS calls like I/O or sleep, not execution. Normally this
-            # isn't too much of a problem, but fingerprinting will take
-            # significant non-I/O processing time, so web requests could be
-            # delayed while fingerprinting occurs.
-            # There is a work-around to the GIL: multiprocessing, using
-            # processes instead of threads. Unfortunately, too much
-            # infrastructure (APScheduler, SQLAlchemy connection pools) depend
-            # on a shared memory space between threads.
+            # Threads in Python are bound by the Global Interpreter Lock, so
+            # CPU-heavy jobs would delay web requests. The one that is,
+            # fingerprinting, hands its work to a pool of processes (see
+            # FINGERPRINT_WORKERS), so the scheduler's threads only wait on
+            # I/O. Too much infrastructure (APScheduler, SQLAlchemy connection
+            # pools) depends on a shared memory space between threads to run
+            # the jobs themselves in processes.
             #'default': ThreadPoolExecutor()
         },
         LANGUAGES=['en'],
         USER_AGENT="MusicGamez/0.1 ( https://musicgamez.info )",
-        PERPAGE=36
+        PERPAGE=36,
+        # rendered list pages only change when the materialized views are
+        # refreshed, every 15 minutes
+        PAGE_CACHE_SIZE=512,
+        PAGE_CACHE_TIMEOUT=15*60,
+        RECORDING_CACHE_SIZE=1024,
+        RECORDING_CACHE_TIMEOUT=60*60,
+        GOOGLE_ANALYTICS_URI=TRACKING_URI,
+        ANALYTICS_BUFFER_SIZE=10000,
+        ANALYTICS_INTERVAL=10,
+        ANALYTICS_CONCURRENCY=4,
+        ANALYTICS_RETRIES=3,
+        SLOW_REQUEST_THRESHOLD=1.0,
+        # /metrics needs "Authorization: Bearer <METRICS_TOKEN>", and is off
+        # without a token
+        METRICS_TOKEN=None,
+        HTTP_TIMEOUT=(5, 30),
+        HTTP_RETRIES=3,
+        HTTP_POOL_CONNECTIONS=10,
+        HTTP_POOL_MAXSIZE=10,
+        # (requests per second, burst) for each host
+        HTTP_RATE_LIMITS={
+            'beatsaver.com': (10, 10),
+            'osu.ppy.sh': (1, 5),
+            'musicbrainz.org': (1, 1),
+            'api.acoustid.org': (3, 3),
+            'docs.google.com': (1, 1),
+            'creatorhype.com': (1, 1)
+        },
+        HTTP_DEFAULT_RATE_LIMIT=(5, 10),
+        # validators for conditional GETs, in instance/http-cache unless set
+        HTTP_CACHE_PATH=None,
+        HTTP_CACHE_SIZE=1024*1024,
+        # pages per run of the hourly crawl and of the backfill
+        CRAWL_MAX_PAGES=50,
+        CRAWL_BACKFILL_PAGES=10,
+        # beatmaps matched by title and artist per run, every 10 seconds
+        MATCH_BATCH_SIZE=5000,
+        # beatmaps without an exact match are looked up in Solr, if set
+        SOLR_URI=None,
+        SEARCH_CANDIDATES=10,
+        SEARCH_CONCURRENCY=4,
+        SEARCH_DURATION_TOLERANCE=10000,
+        SEARCH_MATCH_THRESHOLD=0.85,
+        SCORE_WEIGHTS=DEFAULT_WEIGHTS,
+        SCORE_SITE_DURATION_WEIGHTS=DEFAULT_SITE_DURATION_WEIGHTS,
+        # the best candidate must score this much more than the next to be
+        # the only match
+        SCORE_AMBIGUITY_MARGIN=0.02,
+        # processes decoding and fingerprinting audio
+        FINGERPRINT_WORKERS=default_workers(),
+        # seconds a worker may hold a beatmap before someone else takes it
+        # over, and that a fingerprint or lookup run keeps claiming work
+        CLAIM_LEASE=10*60,
+        CLAIM_RUN_TIME=50,
+        # fingerprints sent per request to the AcoustID lookup endpoint
+        LOOKUP_BATCH_SIZE=10,
+        ACOUSTID_API_URI='https://api.acoustid.org/v2/lookup',
+        # seconds AcoustID results for a song file are reused for
+        AUDIO_LOOKUP_MAX_AGE=30*24*60*60
     )
     app.jinja_options['trim_blocks'] = True
     app.jinja_options['lstrip_blocks'] = True
@@ -187,6 +254,8 @@ def create_app(test_config=None):
 
     db.app = app
     db.init_app(app)
+    page_cache.configure(app.config["PAGE_CACHE_SIZE"], app.config["PAGE_CACHE_TIMEOUT"])
+    recording_cache.configure(app.config["RECORDING_CACHE_SIZE"], app.config["RECORDING_CACHE_TIMEOUT"])
 
     if app.debug:
         jobstore = MemoryJobStore()
@@ -224,7 +293,15 @@ def create_app(test_config=None):
     app.jinja_env.filters['translate_relationship'] = translate_relationship
     app.jinja_env.globals['get_locale'] = get_locale
     
-    app.events = []
+    reporter.init_app(app)
+    metrics.init_app(app)
+    metrics.register_stats("page_cache", page_cache.stats)
+    metrics.register_stats("recording_cache", recording_cache.stats)
+    metrics.register_stats("analytics", reporter.stats)
+    http_client.init_app(app)
+    metrics.register_stats("http", http_client.stats)
+    fingerprint_engine.init_app(app)
+    metrics.register_stats("fingerprint", fingerprint_engine.stats)
     
     @app.before_request
     def prepare_measurement():
@@ -235,19 +312,14 @@ def create_app(test_config=None):
         locale = get_locale()
         language = locale.language
         if locale.variant: language += '-'+locale.variant
-        client_id = str(UUID(bytes=md5((
-            request.headers.get('User-Agent', '') + '\r\n' + \
-            request.headers.get('Accept', '') + '\r\n' + \
-            request.headers.get('Accept-Language', '') + '\r\n' + \
-            request.remote_addr
-        ).encode('utf-8')).digest()[:16]))
-        dnt = request.headers.get('DNT', None) == '1'
-        p = pageview(path=request.path, host_name=request.host, location=request.url,
-            language=language, referrer=request.referrer, cid=client_id,
-            aip='1' if dnt else None, npa=str(int(dnt)), ds='web', uip=request.remote_addr,
-            ua=request.user_agent.string,
+        reporter.record(path=request.path, host=request.host, url=request.url,
+            language=language, referrer=request.referrer,
+            user_agent=request.headers.get('User-Agent', ''),
+            accept=request.headers.get('Accept', ''),
+            accept_language=request.headers.get('Accept-Language', ''),
+            remote_addr=request.remote_addr,
+            dnt=request.headers.get('DNT', None) == '1',
             srt=str(int((time.time()-g.request_start_time)*1000)))
-        app.events.extend(p)
         return response
     
     app.cli.add_command(init_db_command)
@@ -256,7 +328,10 @@ def create_app(test_config=None):
     app.cli.add_command(fetch_beatsaber_command)
     app.cli.add_command(fetch_osu_command)
     app.cli.add_command(fetch_beatsaber_single_command)
+    app.cli.add_command(crawl_backfill_command)
     app.cli.add_command(fetch_beastsaber_command)
+    app.cli.add_command(build_name_keys_command)
+    app.cli.add_command(benchmark_scoring_command)
     app.cli.add_command(create_solr_home)
     app.cli.add_command(export_solr_triggers)
     app.cli.add_command(reindex_solr)
@@ -269,7 +344,49 @@ def select_locale():
     return request.accept_languages.best_match(db.app.config['LANGUAGES'])
 
 
+ARTIST_NAME_ALIAS_TYPE = '894afba6-2816-3c24-8072-eadb66bd04bc'
+RECORDING_NAME_ALIAS_TYPE = '5d564c8f-97de-3572-94bb-7f40ad661499'
+
+
+def preload_translations(recording_ids, artist_credit_ids):
+    """Look up the locale's primary aliases for a whole page of recordings and
+    their credited artists at once, so the translate filters don't each need
+    their own query"""
+    locale = get_locale().language
+    translations = g.setdefault('translations', {RecordingAlias: {}, ArtistAlias: {}})
+    recording_ids = set(recording_ids)
+    artist_credit_ids = set(artist_credit_ids)
+
+    if recording_ids:
+        recordings = translations[RecordingAlias]
+        recordings.update(dict.fromkeys(recording_ids))
+        for recording_id, name in db.session.query(RecordingAlias.recording_id, RecordingAlias.name)\
+                .join(RecordingAliasType)\
+                .filter(RecordingAlias.recording_id.in_(recording_ids),
+                    RecordingAlias.locale==locale,
+                    RecordingAlias.primary_for_locale==True,
+                    RecordingAliasType.gid==RECORDING_NAME_ALIAS_TYPE):
+            recordings[recording_id] = name
+
+    if artist_credit_ids:
+        # outer join, so that artists without an alias are remembered as well
+        aliases = db.session.query(ArtistAlias.artist_id.label("artist_id"), ArtistAlias.name)\
+            .join(ArtistAliasType)\
+            .filter(ArtistAlias.locale==locale,
+                ArtistAlias.primary_for_locale==True,
+                ArtistAliasType.gid==ARTIST_NAME_ALIAS_TYPE)\
+            .subquery()
+        artists = translations[ArtistAlias]
+        for artist_id, name in db.session.query(ArtistCreditName.artist_id, aliases.c.name)\
+                .outerjoin(aliases, aliases.c.artist_id==ArtistCreditName.artist_id)\
+                .filter(ArtistCreditName.artist_credit_id.in_(artist_credit_ids)):
+            artists[artist_id] = name
+
+
 def translate_entity(type, typetype, idcol, id, typegid, name):
+    preloaded = g.get('translations', {}).get(type, {})
+    if id in preloaded:
+        return preloaded[id] or name
     result = db.session.query(type)\
         .join(typetype)\
         .filter(idcol==id,
@@ -281,7 +398,7 @@ def translate_entity(type, typetype, idcol, id, typegid, name):
 
 
 def translate_artist(artist):
-    if isinstance(artist, ArtistCreditName):
+    if hasattr(artist, "artist_id"):
         artist_id = artist.artist_id
     else:
         artist_id = artist.id
@@ -289,7 +406,7 @@ def translate_artist(artist):
         ArtistAliasType,
         ArtistAlias.artist_id,
         artist_id,
-        '894afba6-2816-3c24-8072-eadb66bd04bc',
+        ARTIST_NAME_ALIAS_TYPE,
         artist.name)
 
 
@@ -298,7 +415,7 @@ def translate_recording(recording):
         RecordingAliasType,
         RecordingAlias.recording_id,
         recording.id,
-        '5d564c8f-97de-3572-94bb-7f40ad661499',
+        RECORDING_NAME_ALIAS_TYPE,
         recording.name)
 
 
@@ -363,20 +480,31 @@ def fetch_osu_command():
     match_with_string()
 
 
+@click.command("crawl-backfill")
+@click.argument("site", type=click.Choice(["bs", "osu"]))
+@click.option("--restart", is_flag=True, help="Start again from the newest maps")
+@with_appcontext
+def crawl_backfill_command(site, restart):
+    """Walk further back through a site's maps, continuing the last backfill"""
+    scheduler.shutdown()
+    from musicgamez.main.tasks import crawl_backfill, restart_backfill
+    if restart:
+        restart_backfill(site)
+    crawl_backfill(site)
+
+
 @click.command("fetch-beatsaber-single")
 @click.argument('id')
 @with_appcontext
 def fetch_beatsaber_single_command(id):
     """Manually import a specific Beat Saber map"""
     scheduler.shutdown()
-    from musicgamez.main.tasks import fetch_beatsaber_single, match_with_string, urlopen_with_ua
+    from musicgamez.main.tasks import fetch_beatsaber_single, match_with_string
     from musicgamez.main.models import BeatSite
-    import json
     session = db.create_scoped_session()
-    gametrack = json.load(
-        urlopen_with_ua(
-            "https://beatsaver.com/api/maps/id/" +
-            id))
+    gametrack = http_client.get_json(
+        "https://beatsaver.com/api/maps/id/" +
+        id)
     site = session.query(BeatSite).filter(BeatSite.short_name == 'bs').one()
     fetch_beatsaber_single(site, session, gametrack)
     try:
@@ -387,12 +515,40 @@ def fetch_beatsaber_single_command(id):
 
 
 @click.command("fetch-beatsaber-dump")
+@click.argument("path", required=False)
+@click.option("--restart", is_flag=True, help="Ignore the checkpoint of an interrupted import")
 @with_appcontext
-def fetch_beastsaber_command():
-    """Import all Beat Saber maps"""
+def fetch_beastsaber_command(path, restart):
+    """Import all Beat Saber maps, from a local copy of the dump if PATH is given"""
     scheduler.shutdown()
     from musicgamez.main.tasks import fetch_beatsaber_dump
-    fetch_beatsaber_dump()
+    fetch_beatsaber_dump(path, restart)
+
+
+@click.command("build-name-keys")
+@click.option("--restart", is_flag=True, help="Start again from the first recording")
+@with_appcontext
+def build_name_keys_command(restart):
+    """Build the normalized name keys of every recording, for matching by
+    string, continuing an interrupted build"""
+    scheduler.shutdown()
+    from musicgamez.main.tasks import rebuild_all_name_keys
+    rebuild_all_name_keys(restart)
+
+
+@click.command("benchmark-scoring")
+@click.option("--beatmaps", default=1000, help="Beatmaps in the batch")
+@click.option("--query-beatmaps", default=100, help="Beatmaps to match with one query each")
+@with_appcontext
+def benchmark_scoring_command(beatmaps, query_beatmaps):
+    """Compare matching a batch of beatmaps with choose_recordings to the
+    query per beatmap that was used before"""
+    scheduler.shutdown()
+    from musicgamez.main.tasks import benchmark_scoring
+    batch_rate, query_rate = benchmark_scoring(beatmaps, query_beatmaps)
+    click.echo("Batch: {:.0f} beatmaps/s".format(batch_rate))
+    click.echo("One query per beatmap: {:.0f} beatmaps/s".format(query_rate))
+    click.echo("{:.0f}x faster".format(batch_rate / query_rate))
 
 
 @click.command()
@@ -0,0 +1,152 @@
+import atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from google_measurement_protocol import pageview
+from hashlib import md5
+import logging
+import random
+import requests
+from threading import Event, Lock, Thread
+import time
+from urllib.parse import urlencode
+from uuid import UUID
+
+
+TRACKING_URI = 'https://ssl.google-analytics.com/batch'
+# the batch endpoint accepts at most 20 hits per request
+BATCH_SIZE = 20
+
+logger = logging.getLogger(__name__)
+
+
+def _finalize_payloads(
+        tracking_id: str, payloads,
+        **extra_data):
+    """Get final data for API requests for Google Analytics.
+    Updates payloads setting required non-specific values on data.
+    """
+    extra_payload = {
+        'v': '1', 'tid': tracking_id, 'aip': '1'}
+
+    for payload in payloads:
+        final_payload = dict(payload)
+        final_payload.update(extra_payload)
+        final_payload.update(extra_data)
+        yield urlencode(final_payload)
+
+
+def build_payloads(hit):
+    """Turn the request details recorded by Reporter.record into Measurement
+    Protocol pageview payloads"""
+    client_id = str(UUID(bytes=md5((
+        hit['user_agent'] + '\r\n' +
+        hit['accept'] + '\r\n' +
+        hit['accept_language'] + '\r\n' +
+        hit['remote_addr']
+    ).encode('utf-8')).digest()[:16]))
+    return pageview(path=hit['path'], host_name=hit['host'], location=hit['url'],
+        language=hit['language'], referrer=hit['referrer'], cid=client_id,
+        aip='1' if hit['dnt'] else None, npa=str(int(hit['dnt'])), ds='web',
+        uip=hit['remote_addr'], ua=hit['user_agent'], srt=hit['srt'])
+
+
+class Reporter(object):
+    """Sends page views to Google Analytics from a background thread.
+
+    Request handlers only append the raw request details to a bounded buffer;
+    building the payloads and posting them happens on the worker, several
+    batches at a time. If the upstream is slow and the buffer fills up, the
+    oldest hits are dropped and counted rather than growing without limit.
+
+    The batches are posted with http, anything with a requests-style post(),
+    like the app's HTTP client.
+    """
+
+    def __init__(self, http=None):
+        self.http = http or requests.Session()
+        self.tracking_id = None
+        self.hits = deque()
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self._lock = Lock()
+        self._stopping = Event()
+        self._thread = None
+        self._executor = None
+
+    def init_app(self, app):
+        self.tracking_id = app.config.get('GOOGLE_ANALYTICS_TRACKING_ID')
+        self.uri = app.config['GOOGLE_ANALYTICS_URI']
+        self.user_agent = app.config['USER_AGENT']
+        self.interval = app.config['ANALYTICS_INTERVAL']
+        self.retries = app.config['ANALYTICS_RETRIES']
+        with self._lock:
+            self.hits = deque(self.hits, maxlen=app.config['ANALYTICS_BUFFER_SIZE'])
+        if self.tracking_id is None or self._thread is not None:
+            return
+        self._executor = ThreadPoolExecutor(app.config['ANALYTICS_CONCURRENCY'],
+                                            thread_name_prefix='analytics-send')
+        self._thread = Thread(target=self._run, name='analytics', daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def record(self, **hit):
+        if self.tracking_id is None:
+            return
+        with self._lock:
+            if len(self.hits) == self.hits.maxlen:
+                self.dropped += 1
+            self.hits.append(hit)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            hits = list(self.hits)
+            self.hits.clear()
+        if len(hits) == 0:
+            return
+        payloads = [payload for hit in hits for payload in build_payloads(hit)]
+        batches = [payloads[i:i+BATCH_SIZE] for i in range(0, len(payloads), BATCH_SIZE)]
+        # wait for this round to finish, so a slow upstream holds back the
+        # next round instead of piling up requests
+        list(self._executor.map(self._send, batches))
+
+    def _send(self, batch):
+        data = '\r\n'.join(_finalize_payloads(self.tracking_id, batch))
+        for attempt in range(self.retries + 1):
+            try:
+                self.http.post(self.uri, data=data,
+                    headers={'User-Agent': self.user_agent},
+                    timeout=5.0).raise_for_status()
+            except requests.RequestException as e:
+                error = e
+                if attempt < self.retries and not self._stopping.is_set():
+                    # exponential backoff with full jitter
+                    time.sleep(random.uniform(0, min(30, 2 ** attempt)))
+                continue
+            with self._lock:
+                self.sent += len(batch)
+            return
+        with self._lock:
+            self.failed += len(batch)
+        logger.warning("Dropped {} analytics hits: {}".format(len(batch), error))
+
+    def shutdown(self):
+        """Stop the worker and send whatever is still buffered"""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self.flush()
+        self._executor.shutdown()
+        self._thread = None
+
+    def stats(self):
+        with self._lock:
+            return {"buffered": len(self.hits),
+                    "dropped": self.dropped,
+                    "sent": self.sent,
+                    "failed": self.failed}
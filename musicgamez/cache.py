@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class LRUCache(object):
+    """A thread-safe cache that holds at most maxsize entries, evicting the
+    least recently used one first. Entries also expire after timeout seconds,
+    so processes that miss an explicit clear() don't serve stale data forever.
+    """
+
+    def __init__(self, maxsize=128, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def configure(self, maxsize, timeout=None):
+        with self._lock:
+            self.maxsize = maxsize
+            self.timeout = timeout
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.timeout is None:
+            expires = None
+        else:
+            expires = time.monotonic() + self.timeout
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._entries),
+                    "maxsize": self.maxsize}
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,100 @@
+from acoustid import fingerprint_file
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+from threading import Lock
+
+
+def fingerprint_worker(path):
+    """Decode and fingerprint an audio file, in a worker process. Chromaprint
+    is called through its library rather than by running fpcalc."""
+    duration, fingerprint = fingerprint_file(path, force_fpcalc=False)
+    return duration, fingerprint.decode('ascii')
+
+
+class FingerprintEngine(object):
+    """Fingerprints audio files in a pool of worker processes, so decoding
+    doesn't hold the GIL of the process serving web requests.
+
+    The pool is only started on the first submit, so processes that never
+    fingerprint don't pay for it, and is started again when a worker dies,
+    which breaks it for good. Workers are spawned rather than forked, since
+    the scheduler's threads and the database connection pool don't survive
+    a fork."""
+
+    def __init__(self):
+        self.workers = 1
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.restarts = 0
+        # how often a song file's fingerprint or AcoustID results could be
+        # reused, see AudioFingerprint
+        self.cache = {"fingerprint_hits": 0, "fingerprint_misses": 0,
+                      "lookup_hits": 0, "lookup_misses": 0}
+        self._executor = None
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.workers = app.config['FINGERPRINT_WORKERS']
+
+    def submit(self, path):
+        """Start fingerprinting the file at path, returning a future of its
+        duration and fingerprint"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._start()
+            try:
+                future = self._executor.submit(fingerprint_worker, path)
+            except BrokenProcessPool:
+                # a worker died since the last submit
+                self._executor.shutdown(wait=False)
+                self._executor = self._start()
+                self.restarts += 1
+                future = self._executor.submit(fingerprint_worker, path)
+            self.submitted += 1
+        future.add_done_callback(self._done)
+        return future
+
+    def _start(self):
+        return ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _done(self, future):
+        with self._lock:
+            if future.exception() is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def record_cache(self, kind, hits, misses):
+        """Count cache hits and misses for kind, "fingerprint" or "lookup",
+        and return the overall hit rate"""
+        with self._lock:
+            self.cache[kind + "_hits"] += hits
+            self.cache[kind + "_misses"] += misses
+            total = self.cache[kind + "_hits"] + self.cache[kind + "_misses"]
+            return self.cache[kind + "_hits"] / total if total > 0 else 0
+
+    def shutdown(self):
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown()
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers,
+                    "submitted": self.submitted,
+                    "completed": self.completed,
+                    "failed": self.failed,
+                    "restarts": self.restarts,
+                    "in_flight": self.submitted - self.completed - self.failed,
+                    **self.cache}
+
+
+def default_workers():
+    """Leave a core for the web server and the scheduler"""
+    return max(1, (os.cpu_count() or 1) - 1)
@@ -0,0 +1,310 @@
+from contextlib import contextmanager
+from hashlib import sha1
+import json
+import os
+import random
+import re
+import requests
+from requests.adapters import HTTPAdapter
+from threading import Lock
+import time
+from urllib.parse import urlparse
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class TokenBucket(object):
+    """Allows rate requests per second on average, in bursts of up to burst
+    requests"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            # when in debt, wait until our token has been paid back
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ClientAdapter(HTTPAdapter):
+    """A pooling adapter that applies the client's timeouts, rate limits and
+    retries to every request it sends, and measures them per host"""
+
+    def __init__(self, client, **kwargs):
+        self.client = client
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        client = self.client
+        host = urlparse(request.url).hostname
+        if timeout is None:
+            timeout = client.timeout
+        retries = client.retries if request.method in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            client.bucket(host).acquire()
+            start = time.monotonic()
+            try:
+                response = super().send(request, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                client.record(host, time.monotonic() - start, error=True)
+                if attempt == retries:
+                    raise
+                client.backoff(attempt)
+                continue
+            client.record(host, time.monotonic() - start,
+                          error=response.status_code >= 500)
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            response.close()
+            if retry_after.isdigit():
+                time.sleep(min(int(retry_after), client.max_backoff))
+            else:
+                client.backoff(attempt)
+
+
+class ResponseCache(object):
+    """Keeps the ETag and Last-Modified validators of the last response for
+    a URL on disk, so the next request for it can be conditional. Callers
+    skip their work when nothing changed, so the bodies aren't kept, only
+    their size, to count the bytes that didn't have to be downloaded.
+
+    Each entry is a small JSON file named after a hash of the URL. When they
+    take more than max_size bytes, the least recently used are removed."""
+
+    def __init__(self, path=None, max_size=1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self.size = 0
+        self._lock = Lock()
+
+    def configure(self, path, max_size):
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self.path = path
+            self.max_size = max_size
+
+    def _path(self, url):
+        return os.path.join(self.path, sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _load(self, url):
+        try:
+            with open(self._path(url)) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return {}
+
+    def validators(self, url):
+        """The headers that make a request for url conditional on it having
+        changed since it was cached"""
+        if self.path is None:
+            return {}
+        meta = self._load(url)
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def not_modified(self, url):
+        size = self._load(url).get("size", 0)
+        try:
+            # mark as recently used for eviction
+            os.utime(self._path(url))
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += size
+
+    def store(self, url, response):
+        with self._lock:
+            self.misses += 1
+        if self.path is None:
+            return
+        path = self._path(url)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            # nothing to revalidate with next time
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        # write to a temporary file and rename, so a concurrent reader never
+        # sees half an entry
+        with open(path + ".tmp", "w") as meta_file:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified,
+                       "size": len(response.content)}, meta_file)
+        os.replace(path + ".tmp", path)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.path):
+                if name.endswith(".body"):
+                    # left by versions that kept the bodies
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except OSError:
+                        pass
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for mtime, size, name in entries)
+            for mtime, size, name in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+                total -= size
+                self.evictions += 1
+            self.size = total
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "bytes_saved": self.bytes_saved,
+                    "evictions": self.evictions,
+                    "size": self.size}
+
+
+class HTTPClient(object):
+    """One place for outbound HTTP: a shared session with per-host
+    keep-alive connection pools, default timeouts, retries with jittered
+    exponential backoff, per-host token-bucket rate limits, and per-host
+    request counts and latency.
+
+    Other sessions (like the OAuth ones) can get the same behaviour with
+    mount()."""
+
+    def __init__(self):
+        self.timeout = (5, 30)
+        self.retries = 3
+        self.max_backoff = 30
+        self.rate_limits = {}
+        self.default_rate_limit = None
+        self.user_agent = None
+        self.adapter = ClientAdapter(self)
+        self.response_cache = ResponseCache()
+        self.session = requests.Session()
+        self.mount(self.session)
+        self._buckets = {}
+        self._stats = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.timeout = app.config["HTTP_TIMEOUT"]
+        self.retries = app.config["HTTP_RETRIES"]
+        self.rate_limits = app.config["HTTP_RATE_LIMITS"]
+        self.default_rate_limit = app.config["HTTP_DEFAULT_RATE_LIMIT"]
+        self.user_agent = app.config["USER_AGENT"]
+        self.adapter = ClientAdapter(self,
+            pool_connections=app.config["HTTP_POOL_CONNECTIONS"],
+            pool_maxsize=app.config["HTTP_POOL_MAXSIZE"])
+        self.mount(self.session)
+        self.session.headers["User-Agent"] = self.user_agent
+        self.response_cache.configure(app.config["HTTP_CACHE_PATH"]
+            or os.path.join(app.instance_path, "http-cache"),
+            app.config["HTTP_CACHE_SIZE"])
+        with self._lock:
+            self._buckets.clear()
+
+    def mount(self, session):
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+
+    def bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                limit = self.rate_limits.get(host, self.default_rate_limit)
+                self._buckets[host] = TokenBucket(*limit) if limit else None
+            bucket = self._buckets[host]
+        return bucket or _unlimited
+
+    def backoff(self, attempt):
+        time.sleep(random.uniform(0, min(self.max_backoff, 2 ** attempt)))
+
+    def record(self, host, elapsed, error=False):
+        with self._lock:
+            stats = self._stats.setdefault(host, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += int(error)
+            stats[2] += elapsed
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for host, (count, errors, elapsed) in self._stats.items():
+                name = re.sub(r"\W", "_", host)
+                stats[name + "_requests"] = count
+                stats[name + "_errors"] = errors
+                stats[name + "_seconds"] = elapsed
+            for key, value in self.response_cache.stats().items():
+                stats["cache_" + key] = value
+            return stats
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def get_json(self, url, **kwargs):
+        response = self.get(url, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    @contextmanager
+    def conditional_get(self, url, session=None, cache=True, **kwargs):
+        """GET url, unless it has not changed since the last time it was
+        fetched through here, in which case None is given instead of the
+        response so the caller can skip its work.
+
+        The response only goes in the cache once the with block finishes
+        without an error, so a failed import is retried in full next time."""
+        session = session or self.session
+        headers = dict(kwargs.pop("headers", None) or {})
+        if cache:
+            headers.update(self.response_cache.validators(url))
+        with session.get(url, headers=headers, **kwargs) as response:
+            if cache and response.status_code == 304:
+                self.response_cache.not_modified(url)
+                yield None
+                return
+            response.raise_for_status()
+            yield response
+            if cache:
+                self.response_cache.store(url, response)
+
+
+class _Unlimited(object):
+    def acquire(self):
+        pass
+
+
+_unlimited = _Unlimited()
@@ -6,7 +6,7 @@ from sqlalchemy import event, select, DDL
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.schema import FetchedValue
 from sqlalchemy.sql import func, expression
-from sqlalchemy.orm import backref
+from sqlalchemy.orm import backref, selectinload
 
 
 class BeatSite(db.Model):
@@ -123,6 +123,47 @@ event.listen(
 )
 
 
+class BeatmapClaim(db.Model):
+    """A worker's lease on a beatmap it is processing for a stage of the
+    pipeline. Claims that expire are taken over by the next worker."""
+    beatmap_id = db.Column(db.Integer, db.ForeignKey(Beatmap.id, ondelete='CASCADE'), primary_key=True)
+    # "fingerprint" or "lookup"
+    stage = db.Column(db.String(16), nullable=False)
+    worker = db.Column(db.String, nullable=False)
+    expires = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+
+class AudioFingerprint(db.Model):
+    """The fingerprint of a song file, and what AcoustID said about it, so
+    that maps reusing the same file don't need decoding or looking up again"""
+    # SHA-256 of the song file
+    hash = db.Column(db.String(64), primary_key=True)
+    duration = db.Column(db.Float, nullable=False)
+    fingerprint = db.Column(db.String, nullable=False)
+    # the AcoustID results, once looked up
+    lookup = db.Column(JSONB)
+    looked_up = db.Column(db.DateTime(timezone=True))
+
+
+class BeatmapAudio(db.Model):
+    """Which song file a beatmap was fingerprinted from"""
+    beatmap_id = db.Column(db.Integer, db.ForeignKey(Beatmap.id, ondelete='CASCADE'), primary_key=True)
+    audio_hash = db.Column(db.String(64), db.ForeignKey(AudioFingerprint.hash), nullable=False, index=True)
+
+
+class CrawlState(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    site_id = db.Column(
+        db.Integer, db.ForeignKey(
+            BeatSite.id), nullable=False)
+    site = db.relationship(BeatSite)
+    # "incremental" or "backfill"
+    mode = db.Column(db.String(16), nullable=False)
+    i = db.Index('crawl_site_mode', site_id, mode, unique=True)
+    cursor = db.Column(JSONB)
+    updated = db.Column(db.DateTime, server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
 class ArtistStreamPermission(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     artist_gid = db.Column(UUID, db.ForeignKey(Artist.gid), unique=True)
@@ -139,6 +180,138 @@ class LabelStreamPermission(db.Model):
     source = db.Column(db.String)
 
 
+# The permission imports resolve spreadsheet names case-insensitively, and
+# matching by string does too until the name keys are built, which needs
+# indexes on the lowercased names of the MusicBrainz tables
+name_indexes = {
+    entity: DDL("CREATE INDEX IF NOT EXISTS ix_{}_lower_name ON {} (lower(name))".format(
+        entity.__table__.name, entity.__table__.fullname))
+    for entity in (Artist, Label, Recording, ArtistCredit)
+}
+event.listen(ArtistStreamPermission.__table__, 'after_create', name_indexes[Artist])
+event.listen(LabelStreamPermission.__table__, 'after_create', name_indexes[Label])
+event.listen(Beatmap.__table__, 'after_create', name_indexes[Recording])
+event.listen(Beatmap.__table__, 'after_create', name_indexes[ArtistCredit])
+
+# build-name-keys drops these once it has completed, since nothing else uses
+# them and they are big
+drop_fallback_name_indexes = [
+    DDL("DROP INDEX IF EXISTS {}.ix_{}_lower_name".format(entity.__table__.schema, entity.__table__.name))
+    for entity in (Recording, ArtistCredit)
+]
+
+
+class RecordingNameKey(db.Model):
+    """Every title and artist pair a recording is known by, through its
+    name, aliases, tracks, artist credits and artist aliases, as normalized
+    by musicgamez.matching.match_keys"""
+    # musicgamez.matching.key_digest of the key, since long names make keys
+    # that don't fit in an index row
+    key = db.Column(db.String(32), primary_key=True)
+    # no foreign key, so that MusicBrainz replication can delete recordings
+    recording_id = db.Column(db.Integer, primary_key=True, index=True)
+
+
+class NameKeyBuild(db.Model):
+    """How far build-name-keys got. Until it has been through every
+    recording once, matching by string falls back to lowercased names."""
+    id = db.Column(db.Integer, primary_key=True)
+    last_recording_id = db.Column(db.Integer, nullable=False, default=0)
+    completed = db.Column(db.DateTime(timezone=True))
+
+
+# After replication, update_name_keys looks for the recordings whose names
+# changed by last_updated, which MusicBrainz doesn't index. build-name-keys
+# creates these too, for databases where RecordingNameKey already exists.
+last_updated_indexes = DDL("; ".join(
+    "CREATE INDEX IF NOT EXISTS ix_{}_last_updated ON {} (last_updated)".format(
+        entity.__table__.name, entity.__table__.fullname)
+    for entity in (Recording, RecordingAlias, Track, Artist, ArtistAlias)))
+event.listen(RecordingNameKey.__table__, 'after_create', last_updated_indexes)
+
+
+def release_date_key():
+    """The earliest date a release came out, as a sortable YYYYMMDD number"""
+    events = expression.union_all(
+        select([ReleaseCountry.release_id.label("release_id"), ReleaseCountry.date_year, ReleaseCountry.date_month, ReleaseCountry.date_day]),
+        select([ReleaseUnknownCountry.release_id.label("release_id"), ReleaseUnknownCountry.date_year, ReleaseUnknownCountry.date_month, ReleaseUnknownCountry.date_day])
+    ).alias("release_event")
+    return select([func.min(
+            events.c.date_year * 10000
+            + func.coalesce(events.c.date_month, 0) * 100
+            + func.coalesce(events.c.date_day, 0))])\
+        .where(events.c.release_id == Release.id)\
+        .as_scalar()
+
+
+# Front covers of every recording with beatmaps, ranked so that the choice of
+# cover is stable between refreshes: the most recent release first, then in
+# the order the release's covers are shown on the Cover Art Archive
+front_covers = select(
+    [
+        Track.recording_id.label("recording_id"),
+        Release.gid.label("release_gid"),
+        Release.name.label("release_name"),
+        CoverArt.id.label("cover_art_id"),
+        CoverArt.ordering.label("ordering"),
+        release_date_key().label("release_date")
+    ]
+)\
+.select_from(
+    Release.__table__
+    .join(CoverArt)
+    .join(Medium)
+    .join(Track)
+    .join(CoverArtType)
+    .join(ArtType)
+)\
+.where(ArtType.gid == "ac337166-a2b3-340c-a0b4-e2b00f1d40a2")\
+.where(Track.recording_id.in_(
+    select([Recording.id]).select_from(Recording.__table__.join(Beatmap))
+))\
+.distinct()\
+.alias("front_cover")
+
+
+class RecordingCoverView(db.Model):
+    __table__ = view(
+        "recording_cover_view",
+        db.metadata,
+        select(
+            [
+                front_covers.c.recording_id,
+                front_covers.c.release_gid,
+                front_covers.c.release_name,
+                front_covers.c.cover_art_id,
+                func.row_number().over(
+                    partition_by=front_covers.c.recording_id,
+                    order_by=[
+                        front_covers.c.release_date.desc().nullslast(),
+                        front_covers.c.ordering,
+                        front_covers.c.cover_art_id
+                    ]
+                ).label("rank")
+            ]
+        ),
+        material=True
+    )
+    __mapper_args__ = {"primary_key": [__table__.c.recording_id, __table__.c.cover_art_id]}
+    unique_index = db.Index('ix_public_recording_cover_view_unique', __table__.c.recording_id, __table__.c.cover_art_id, unique=True)
+    rank_index = db.Index('ix_public_recording_cover_view_rank', __table__.c.recording_id, __table__.c.rank)
+
+event.listen(
+    db.metadata,
+    'after_create',
+    DDL("CREATE UNIQUE INDEX IF NOT EXISTS ix_public_recording_cover_view_unique ON recording_cover_view (recording_id, cover_art_id)")
+)
+
+event.listen(
+    db.metadata,
+    'after_create',
+    DDL("CREATE INDEX IF NOT EXISTS ix_public_recording_cover_view_rank ON recording_cover_view (recording_id, rank)")
+)
+
+
 class MiniRecordingView(db.Model):
     __table__ = view(
         "mini_recording_view",
@@ -192,19 +365,9 @@ class MiniRecordingView(db.Model):
                     )
                     .limit(1)
                     .label("permission_url"),
-                select([Release.gid.concat("/").concat(CoverArt.id)])
-                    .select_from(
-                        Release.__table__
-                        .join(CoverArt)
-                        .join(Medium)
-                        .join(Track)
-                        .join(CoverArtType)
-                        .join(ArtType)
-                    )
-                    .where(Track.recording_id == Recording.id)
-                    .where(ArtType.gid == "ac337166-a2b3-340c-a0b4-e2b00f1d40a2")
-                    .order_by(func.random())
-                    .limit(1)
+                select([RecordingCoverView.release_gid.concat("/").concat(RecordingCoverView.cover_art_id)])
+                    .where(RecordingCoverView.recording_id == Recording.id)
+                    .where(RecordingCoverView.rank == 1)
                     .label("cover_id"),
                 select(
                     [
@@ -222,7 +385,10 @@ class MiniRecordingView(db.Model):
                         )
                     ]
                 ).label("selfpublish"),
-                func.max(Beatmap.date).label("date")
+                # recordings whose maps have no date sort as the oldest, so
+                # that keyset pagination has a date to seek from for all
+                func.coalesce(func.max(Beatmap.date),
+                              expression.literal_column("timestamp 'epoch'", type_=db.DateTime)).label("date")
             ]
         )
         .select_from(Recording.__table__.join(Beatmap))
@@ -235,6 +401,7 @@ class MiniRecordingView(db.Model):
     beatmaps = db.relationship(Beatmap)
     id_index = db.Index('ix_public_mini_recording_view_id', __table__.c.id, unique=True)
     gid_index = db.Index('ix_public_mini_recording_view_gid', __table__.c.gid, unique=True)
+    date_index = db.Index('ix_public_mini_recording_view_date', __table__.c.date, __table__.c.id)
 
 event.listen(
     db.metadata,
@@ -242,6 +409,12 @@ event.listen(
     DDL("CREATE UNIQUE INDEX IF NOT EXISTS ix_public_mini_recording_view_id ON mini_recording_view (id)")
 )
 
+event.listen(
+    db.metadata,
+    'after_create',
+    DDL("CREATE INDEX IF NOT EXISTS ix_public_mini_recording_view_date ON mini_recording_view (date, id)")
+)
+
 event.listen(
     db.metadata,
     'after_create',
@@ -249,6 +422,77 @@ event.listen(
 )
 
 
+def browse_view(name, columns, from_clause):
+    """A materialized view of which recordings with beatmaps are linked to
+    one kind of entity through their tracks. There is one per kind, since
+    joining releases, labels and tags in one view gives a row for every
+    combination of a release's labels and tags."""
+    return view(
+        name,
+        db.metadata,
+        select([Track.recording_id.label("recording_id")] + columns)
+        .select_from(from_clause)
+        .where(Track.recording_id.in_(
+            select([Recording.id]).select_from(Recording.__table__.join(Beatmap))
+        ))
+        .distinct(),
+        material=True
+    )
+
+
+class RecordingReleaseView(db.Model):
+    __table__ = browse_view(
+        "recording_release_view",
+        [Release.id.label("release_id"), Release.release_group_id.label("release_group_id")],
+        Track.__table__.join(Medium).join(Release)
+    )
+    __mapper_args__ = {"primary_key": [__table__.c.release_id, __table__.c.recording_id]}
+    unique_index = db.Index('ix_public_recording_release_view_release_id', __table__.c.release_id, __table__.c.recording_id, unique=True)
+    release_group_index = db.Index('ix_public_recording_release_view_release_group_id', __table__.c.release_group_id, __table__.c.recording_id)
+
+
+class RecordingLabelView(db.Model):
+    __table__ = browse_view(
+        "recording_label_view",
+        [ReleaseLabel.label_id.label("label_id")],
+        Track.__table__.join(Medium).join(ReleaseLabel, ReleaseLabel.release_id == Medium.release_id)
+    )
+    __mapper_args__ = {"primary_key": [__table__.c.label_id, __table__.c.recording_id]}
+    unique_index = db.Index('ix_public_recording_label_view_label_id', __table__.c.label_id, __table__.c.recording_id, unique=True)
+
+
+class RecordingTagView(db.Model):
+    __table__ = browse_view(
+        "recording_tag_view",
+        [ReleaseTag.tag_id.label("tag_id")],
+        Track.__table__.join(Medium).join(ReleaseTag, ReleaseTag.release_id == Medium.release_id)
+    )
+    __mapper_args__ = {"primary_key": [__table__.c.tag_id, __table__.c.recording_id]}
+    unique_index = db.Index('ix_public_recording_tag_view_tag_id', __table__.c.tag_id, __table__.c.recording_id, unique=True)
+
+# the unique indexes are needed to refresh the views concurrently, and lead
+# with the column that is browsed by
+for view_name, column, unique in (("recording_release_view", "release_id", "UNIQUE "),
+                                  ("recording_release_view", "release_group_id", ""),
+                                  ("recording_label_view", "label_id", "UNIQUE "),
+                                  ("recording_tag_view", "tag_id", "UNIQUE ")):
+    event.listen(
+        db.metadata,
+        'after_create',
+        DDL("CREATE {2}INDEX IF NOT EXISTS ix_public_{0}_{1} ON {0} ({1}, recording_id)".format(view_name, column, unique))
+    )
+
+
+def recordinglist_options():
+    """Loader options for everything recordinglist.html touches, so that a
+    whole page of MiniRecordingViews is loaded in a fixed number of queries"""
+    return (selectinload(MiniRecordingView.artist_credit)
+                .selectinload(ArtistCredit.artists)
+                .joinedload(ArtistCreditName.artist),
+            # Beatmap.external_site is already joined
+            selectinload(MiniRecordingView.beatmaps))
+
+
 class GenreCloud(db.Model):
     __table__ = view(
         "genre_cloud",
@@ -1,38 +1,86 @@
-from acoustid import fingerprint_file, lookup, WebServiceError
+from acoustid import WebServiceError
 from argparse import Namespace
 from bs4 import BeautifulSoup
 import codecs
+from collections import namedtuple
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from dateutil.parser import isoparse
+import hashlib
+import io
 import json
 from mbdata.models import ArtistCredit, Recording
 from mbdata.models import Artist, Label
 from mbdata.replication import mbslave_sync_main, Config
-from musicgamez import scheduler, db, oauth_osu_noauth
+from musicgamez import scheduler, db, fingerprint_engine, http_client, oauth_osu_noauth, page_cache, recording_cache
 from musicgamez.main.models import *
+from musicgamez.main.views import load_genre_cloud
+from musicgamez.matching import key_digest, match_key, match_keys, string_similarity
+from musicgamez.scoring import best_candidates, score_candidates
+from musicgamez.search import recording_query, search_recordings
+import numpy as np
 import os
 import psycopg2
+import requests
+import socket
 import sqlalchemy
-from sqlalchemy.sql import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import func, expression
+import time
 from tempfile import TemporaryFile, NamedTemporaryFile
+import threading
 from urllib.parse import urlencode
-from urllib.request import urlopen, Request
 from zipfile import ZipFile
-import requests
 
 
-def urlopen_with_ua(u, **kwargs):
-    headers = {"User-Agent": db.app.config["USER_AGENT"]}
-    if "headers" in kwargs:
-        headers.update(kwargs.pop("headers"))
-    return urlopen(Request(u, headers=headers, **kwargs))
+# rows per INSERT statement when ingesting beatmaps
+INGEST_CHUNK_SIZE = 500
 
 
-def fetch_beatsaber_single(site, session, gametrack_or_id):
-    if isinstance(gametrack_or_id, str):
-        gametrack = json.load(urlopen_with_ua("https://beatsaver.com/api/maps/id/" + gametrack_or_id))
-    else:
-        gametrack = gametrack_or_id
+def ingest_beatmaps(session, site, beatmaps, update=False):
+    """Write parsed beatmaps for one site, with a single
+    INSERT ... ON CONFLICT statement (and transaction) per chunk. Maps that
+    already exist are skipped, or with update=True have their metadata
+    refreshed if it changed. Returns the number of inserted and updated
+    beatmaps."""
+    inserted = 0
+    updated = 0
+    for i in range(0, len(beatmaps), INGEST_CHUNK_SIZE):
+        # a statement can't touch the same row twice, so keep only the last
+        # copy of any map that appears more than once
+        chunk = list({bm['external_id']: dict(bm, external_site_id=site.id)
+                      for bm in beatmaps[i:i+INGEST_CHUNK_SIZE]}.values())
+        stmt = insert(Beatmap.__table__).values(chunk)
+        if update:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Beatmap.external_id, Beatmap.external_site_id],
+                set_={column: stmt.excluded[column] for column in
+                      ('artist', 'title', 'choreographer', 'date', 'extra')},
+                where=Beatmap.extra.is_distinct_from(stmt.excluded.extra))
+        else:
+            stmt = stmt.on_conflict_do_nothing(
+                index_elements=[Beatmap.external_id, Beatmap.external_site_id])
+        # xmax is only zero for rows that this statement inserted
+        stmt = stmt.returning(expression.literal_column("xmax = 0").label("inserted"),
+                              Beatmap.recording_gid)
+        gids = set()
+        for row in session.execute(stmt):
+            if row.inserted:
+                inserted += 1
+            else:
+                updated += 1
+                if row.recording_gid is not None:
+                    gids.add(row.recording_gid)
+        session.commit()
+        # the ORM's invalidate_recording_detail doesn't see this statement
+        for gid in gids:
+            recording_cache.pop(str(gid))
+    return inserted, updated
+
+
+def parse_beatsaber(gametrack):
     meta = gametrack['metadata']
     songName = meta['songName']
     mapperName = meta['levelAuthorName']
@@ -41,70 +89,174 @@ def fetch_beatsaber_single(site, session, gametrack_or_id):
     else:
         artistName = meta['songAuthorName']
 
-    q = session.query(Beatmap).filter(Beatmap.external_site == site,
-                                      Beatmap.external_id == gametrack['id'])
-    if q.count() > 0:
+    return dict(artist=artistName,
+                title=songName,
+                external_id=gametrack['id'],
+                choreographer=mapperName,
+                date=gametrack['uploaded'],
+                duration=meta['duration'],
+                extra=gametrack)
+
+
+def fetch_beatsaber_single(site, session, gametrack_or_id):
+    if isinstance(gametrack_or_id, str):
+        gametrack = http_client.get_json("https://beatsaver.com/api/maps/id/" + gametrack_or_id)
+    else:
+        gametrack = gametrack_or_id
+    bm = parse_beatsaber(gametrack)
+    inserted, updated = ingest_beatmaps(session, site, [bm])
+    if inserted == 0:
         return
 
-    bm = Beatmap(artist=artistName,
-                 title=songName,
-                 external_id=gametrack['id'],
-                 external_site=site,
-                 choreographer=mapperName,
-                 date=gametrack['uploaded'],
-                 duration=meta['duration'],
-                 extra=gametrack)
+    return session.query(Beatmap).filter(Beatmap.external_site == site,
+                                         Beatmap.external_id == bm['external_id']).one()
 
-    session.add(bm)
-    session.commit()
 
-    return bm
+BEATSABER_DUMP_URL = "https://github.com/andruzzzhka/BeatSaberScrappedData/raw/master/beatSaverScrappedData.json"
 
 
-def fetch_beatsaber_dump():
-    with db.app.app_context():
-        imported = 0
-        session = db.create_scoped_session()
+def iter_json_array(f, offset=0, read_size=1 << 16):
+    """Parse a JSON array from a binary file one element at a time, yielding
+    each element along with the byte offset just past it. With a non-zero
+    offset, f must already be positioned at that offset inside the array,
+    like after resuming from a previously yielded offset."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ""
+    eof = False
 
-        site = session.query(BeatSite).filter(
-            BeatSite.short_name == 'bs').one()
+    def read_more():
+        nonlocal buf, eof
+        data = f.read(read_size)
+        eof = len(data) == 0
+        buf += utf8.decode(data, final=eof)
 
-        for gametrack in json.load(urlopen_with_ua("https://github.com/andruzzzhka/BeatSaberScrappedData/raw/master/beatSaverScrappedData.json")):
-            if fetch_beatsaber_single(site, session, gametrack) is not None:
-                imported += 1
+    pos = 0
+    # the position in buf that offset refers to
+    mark = 0
+    started = offset > 0
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                raise ValueError("JSON array ended unexpectedly")
+            read_more()
+            continue
+        if not started:
+            if buf[pos] != "[":
+                raise ValueError("Expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            element, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read_more()
+            continue
+        offset += len(buf[mark:end].encode('utf-8'))
+        pos = mark = end
+        yield element, offset
+        # drop what has been parsed now and then, rather than every element
+        if mark > read_size:
+            buf = buf[mark:]
+            pos = mark = 0
 
-        db.app.logger.info(
-            "Imported {} beatmaps for {}".format(
-                imported, site.name))
-        session.remove()
 
+def dump_validators(response):
+    """What identifies the version of the dump a download is of"""
+    return {'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')}
 
-@scheduler.task('interval', id='fetch_beatsaber', hours=1, jitter=60)
-def fetch_beatsaber():
+
+def fetch_beatsaber_dump(path=None, restart=False):
+    """Import every map in a BeatSaberScrappedData dump, from a local file or
+    downloaded. The dump is parsed and written in chunks as it streams in,
+    and the byte offset of the last written chunk is saved so that an
+    interrupted import picks up where it stopped.
+
+    A download only resumes if the dump hasn't changed since, going by the
+    ETag or Last-Modified saved with the offset. Otherwise it starts over."""
     with db.app.app_context():
         imported = 0
         session = db.create_scoped_session()
 
         site = session.query(BeatSite).filter(
             BeatSite.short_name == 'bs').one()
-        before = None
-
-        for page in range(10):
-            url = "https://beatsaver.com/api/maps/latest?automapper=false"
-            if before is not None:
-                url += "&before="+before
-            response = json.load(urlopen_with_ua(url))
-
-            lastPage = False
-            for gametrack in response['docs']:
-                if fetch_beatsaber_single(site, session, gametrack) is None:
-                    lastPage = True
-                    break
-                imported += 1
-                before = gametrack['uploaded']
 
-            if lastPage:
-                break
+        source = path or BEATSABER_DUMP_URL
+        checkpoint_path = os.path.join(db.app.instance_path, "beatsaber-dump.checkpoint")
+        checkpoint = {}
+        if not restart and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if checkpoint['source'] != source:
+                checkpoint = {}
+        offset = checkpoint.get('offset', 0)
+        validators = {}
+
+        if path is not None:
+            f = open(path, 'rb')
+            f.seek(offset)
+        else:
+            response = None
+            # Last-Modified is the same whatever the encoding of the earlier
+            # download was, unlike an ETag, and a weak ETag can't be used to
+            # combine ranges at all
+            etag = checkpoint.get('etag')
+            if checkpoint.get('last_modified'):
+                validator = 'last_modified'
+            elif etag and not etag.startswith('W/'):
+                validator = 'etag'
+            else:
+                validator = None
+            if offset > 0 and validator is not None:
+                # the offset counts decoded bytes, and a range of a
+                # compressed response would count compressed ones
+                headers = {"Range": "bytes={}-".format(offset),
+                           "If-Range": checkpoint[validator],
+                           "Accept-Encoding": "identity"}
+                response = http_client.get(source, headers=headers, stream=True)
+                response.raise_for_status()
+                if response.status_code == 206 and \
+                        dump_validators(response)[validator] != checkpoint[validator]:
+                    # the server sent a range of a different version anyway
+                    response.close()
+                    response = None
+            if response is None:
+                response = http_client.get(source, stream=True)
+                response.raise_for_status()
+            if response.status_code != 206:
+                # the dump changed or the server ignored the range, so
+                # start over
+                offset = 0
+            validators = dump_validators(response)
+            f = response.raw
+            f.decode_content = True
+        if offset > 0:
+            db.app.logger.info("Resuming Beat Saber dump import at byte {}".format(offset))
+
+        def write(chunk, offset):
+            inserted, updated = ingest_beatmaps(session, site, chunk)
+            with open(checkpoint_path, 'w') as checkpoint_file:
+                json.dump(dict(validators, source=source, offset=offset), checkpoint_file)
+            return inserted
+
+        with f:
+            chunk = []
+            for gametrack, end in iter_json_array(f, offset):
+                chunk.append(parse_beatsaber(gametrack))
+                if len(chunk) == INGEST_CHUNK_SIZE:
+                    imported += write(chunk, end)
+                    chunk = []
+            if len(chunk) > 0:
+                imported += write(chunk, end)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
 
         db.app.logger.info(
             "Imported {} beatmaps for {}".format(
@@ -118,65 +270,228 @@ def osu_auth():
     oauth_osu_noauth.session.fetch_token(oauth_osu_noauth.token_url, include_client_id=True, client_secret=db.app.config["OSU_CLIENT_SECRET"], scope="public")
 
 
+def parse_osu(gametrack):
+    return dict(artist=gametrack['artist_unicode'],
+                title=gametrack['title_unicode'],
+                external_id=str(gametrack['id']),
+                choreographer=gametrack['creator'],
+                date=gametrack['submitted_date'],
+                duration=max([variant['total_length'] for variant in gametrack['beatmaps']], default=None),
+                extra=gametrack)
+
+
 def fetch_osu_single(site, db_session, gametrack_or_id):
     if isinstance(gametrack_or_id, str):
         if not oauth_osu_noauth.session.authorized:
             osu_auth()
         gametrack = oauth_osu_noauth.session.get("https://osu.ppy.sh/api/v2/beatmapsets/"+gametrack_or_id).json()
-        extId = gametrack_or_id
     else:
         gametrack = gametrack_or_id
-        extId = str(gametrack['id'])
-    q = db_session.query(Beatmap).filter(Beatmap.external_site == site,
-                                         Beatmap.external_id == extId)
-    if q.count() > 0:
+    bm = parse_osu(gametrack)
+    inserted, updated = ingest_beatmaps(db_session, site, [bm])
+    if inserted == 0:
         return
 
-    bm = Beatmap(artist=gametrack['artist_unicode'],
-                 title=gametrack['title_unicode'],
-                 external_id=extId,
-                 external_site=site,
-                 choreographer=gametrack['creator'],
-                 date=gametrack['submitted_date'],
-                 duration=max([variant['total_length'] for variant in gametrack['beatmaps']], default=None),
-                 extra=gametrack)
+    return db_session.query(Beatmap).filter(Beatmap.external_site == site,
+                                            Beatmap.external_id == bm['external_id']).one()
 
-    db_session.add(bm)
-    db_session.commit()
-    
-    return bm
 
+def crawl_time(timestamp):
+    """Parse an API timestamp into a naive UTC datetime, like Beatmap.date"""
+    parsed = isoparse(timestamp)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
 
-@scheduler.task('interval', id='fetch_osu', hours=1, jitter=60)
-def fetch_osu():
+
+def beatsaber_page_url(cursor):
+    url = "https://beatsaver.com/api/maps/latest?automapper=false"
+    if cursor is not None:
+        url += "&before="+cursor
+    return url
+
+
+def beatsaber_read_page(page):
+    docs = page['docs']
+    return docs, docs[-1]['uploaded'] if len(docs) > 0 else None
+
+
+def osu_page_url(cursor):
+    return "https://osu.ppy.sh/api/v2/beatmapsets/search?sort=updated_desc&s=any&" + \
+        urlencode({
+            "cursor[{}]".format(k): v for k,
+            v in (cursor or {}).items()})
+
+
+def osu_read_page(page):
+    return page['beatmapsets'], page.get('cursor')
+
+
+def osu_session():
+    if not oauth_osu_noauth.session.authorized:
+        osu_auth()
+    return oauth_osu_noauth.session
+
+
+# For each site: the URL of a page of maps (newest first), how to get the maps
+# and the cursor to the next page out of it, the session to fetch it with, how
+# to parse a map, how to tell when a map was last changed, and whether maps
+# seen again should have their metadata updated
+Crawler = namedtuple('Crawler', 'page_url read_page session parse timestamp update')
+CRAWLERS = {
+    'bs': Crawler(beatsaber_page_url, beatsaber_read_page, lambda: http_client.session,
+                  parse_beatsaber, lambda gametrack: gametrack['uploaded'], False),
+    # the search is sorted by last update, so refresh what changed
+    'osu': Crawler(osu_page_url, osu_read_page, osu_session,
+                   parse_osu, lambda gametrack: gametrack['last_updated'], True),
+}
+
+
+def get_crawl_state(session, site, mode):
+    state = session.query(CrawlState)\
+        .filter(CrawlState.site == site, CrawlState.mode == mode)\
+        .one_or_none()
+    if state is None:
+        state = CrawlState(site=site, mode=mode, cursor={})
+        session.add(state)
+    return state
+
+
+def crawl_incremental(short_name):
+    """Fetch new maps for a site, newest first, until reaching the newest map
+    the previous crawl saw. The position is saved after every page, so if
+    there are more new maps than one run can walk, the next run continues
+    where this one stopped."""
+    crawler = CRAWLERS[short_name]
     with db.app.app_context():
         imported = 0
+        updated = 0
         session = db.create_scoped_session()
 
         site = session.query(BeatSite).filter(
-            BeatSite.short_name == 'osu').one()
-        
-        osu_auth()
+            BeatSite.short_name == short_name).one()
+        state = get_crawl_state(session, site, 'incremental')
+        cursor = dict(state.cursor or {})
+        if not cursor.get('walking'):
+            newest = cursor.get('newest')
+            if newest is None:
+                newest = session.query(func.max(Beatmap.date))\
+                    .filter(Beatmap.external_site == site)\
+                    .scalar()
+                newest = newest.isoformat() if newest is not None else None
+            cursor = {'newest': newest, 'walking': True, 'page': None, 'walk_newest': None}
 
-        cursor = {}
-        for page in range(1):
-            response = oauth_osu_noauth.session.get(
-                    "https://osu.ppy.sh/api/v2/beatmapsets/search?sort=updated_desc&s=any&" +
-                    urlencode(cursor)).json()
-            cursor = {
-                "cursor[{}]".format(k): v for k,
-                v in response['cursor'].items()}
+        for page in range(db.app.config['CRAWL_MAX_PAGES']):
+            # the first page only changes when there are new maps, so it is
+            # fetched conditionally
+            with http_client.conditional_get(crawler.page_url(cursor['page']),
+                    session=crawler.session(), cache=cursor['page'] is None) as response:
+                if response is None:
+                    cursor = {'newest': cursor['newest'], 'walking': False}
+                    state.cursor = cursor
+                    session.commit()
+                    db.app.logger.info("No new beatmaps for {}".format(site.name))
+                    break
+                gametracks, next_page = crawler.read_page(response.json())
+                page_inserted, page_updated = ingest_beatmaps(session, site,
+                    [crawler.parse(gametrack) for gametrack in gametracks], crawler.update)
+                imported += page_inserted
+                updated += page_updated
 
-            for gametrack in response['beatmapsets']:
-                if fetch_osu_single(site, session, gametrack) is not None:
-                    imported += 1
+                if len(gametracks) > 0 and cursor['walk_newest'] is None:
+                    cursor['walk_newest'] = crawler.timestamp(gametracks[0])
+                caught_up = len(gametracks) == 0 or next_page is None or (
+                    cursor['newest'] is not None and
+                    crawl_time(crawler.timestamp(gametracks[-1])) <= crawl_time(cursor['newest']))
+                if caught_up:
+                    cursor = {'newest': cursor['walk_newest'] or cursor['newest'], 'walking': False}
+                else:
+                    cursor['page'] = next_page
+                state.cursor = dict(cursor)
+                session.commit()
+            if caught_up:
+                break
+        else:
+            db.app.logger.info(
+                "Crawl of {} has not caught up yet, continuing next time".format(site.name))
 
         db.app.logger.info(
-            "Imported {} beatmaps for {}".format(
-                imported, site.name))
+            "Imported {} and updated {} beatmaps for {}".format(
+                imported, updated, site.name))
         session.remove()
 
 
+def crawl_backfill(short_name):
+    """Walk a site's whole history a few pages at a time, to pick up maps the
+    incremental crawl missed. Once it reaches the end it stops until it is
+    restarted."""
+    crawler = CRAWLERS[short_name]
+    with db.app.app_context():
+        session = db.create_scoped_session()
+
+        site = session.query(BeatSite).filter(
+            BeatSite.short_name == short_name).one()
+        state = get_crawl_state(session, site, 'backfill')
+        cursor = dict(state.cursor or {})
+        if cursor.get('done'):
+            session.remove()
+            return
+
+        imported = 0
+        for page in range(db.app.config['CRAWL_BACKFILL_PAGES']):
+            with crawler.session().get(crawler.page_url(cursor.get('page'))) as response:
+                response.raise_for_status()
+                gametracks, next_page = crawler.read_page(response.json())
+            inserted, updated = ingest_beatmaps(session, site,
+                [crawler.parse(gametrack) for gametrack in gametracks])
+            imported += inserted
+            done = len(gametracks) == 0 or next_page is None
+            cursor = {'page': next_page,
+                      'done': done,
+                      'imported': cursor.get('imported', 0) + inserted}
+            state.cursor = cursor
+            session.commit()
+            if done:
+                db.app.logger.info(
+                    "Finished backfilling {}, {} beatmaps imported".format(
+                        site.name, cursor['imported']))
+                break
+
+        if imported > 0:
+            db.app.logger.info(
+                "Backfilled {} beatmaps for {}".format(
+                    imported, site.name))
+        session.remove()
+
+
+def restart_backfill(short_name):
+    with db.app.app_context():
+        session = db.create_scoped_session()
+        site = session.query(BeatSite).filter(
+            BeatSite.short_name == short_name).one()
+        get_crawl_state(session, site, 'backfill').cursor = {}
+        session.commit()
+        session.remove()
+
+
+@scheduler.task('interval', id='fetch_beatsaber', hours=1, jitter=60)
+def fetch_beatsaber():
+    crawl_incremental('bs')
+
+
+@scheduler.task('interval', id='fetch_osu', hours=1, jitter=60)
+def fetch_osu():
+    with db.app.app_context():
+        osu_auth()
+    crawl_incremental('osu')
+
+
+@scheduler.task('interval', id='crawl_backfill', minutes=10, jitter=60)
+def backfill():
+    for short_name in CRAWLERS:
+        crawl_backfill(short_name)
+
+
 def fetch_single(site, session, gametrack_or_id):
     return {
         'bs': fetch_beatsaber_single,
@@ -184,115 +499,474 @@ def fetch_single(site, session, gametrack_or_id):
     }[site.short_name](site, session, gametrack_or_id)
 
 
+created_name_indexes = set()
+
+
+def ensure_name_indexes(session, *entities):
+    """Create the lowercased name indexes on databases that were set up
+    before they existed, once per process"""
+    for entity in entities:
+        if entity not in created_name_indexes:
+            session.execute(name_indexes[entity])
+            session.commit()
+            created_name_indexes.add(entity)
+
+
+# Spreadsheet rows waiting to be resolved to MusicBrainz entities, created per
+# import with ON COMMIT DROP
+permission_import = sqlalchemy.Table(
+    'permission_import', sqlalchemy.MetaData(),
+    sqlalchemy.Column('entity', sqlalchemy.String),
+    sqlalchemy.Column('name', sqlalchemy.String),
+    sqlalchemy.Column('url', sqlalchemy.String))
+
+PERMISSION_ENTITIES = {
+    'artist': (Artist, ArtistStreamPermission, 'artist_gid'),
+    'label': (Label, LabelStreamPermission, 'label_gid'),
+}
+
+
+def import_stream_permissions(session, source, rows):
+    """Add stream permissions from (entity, name, url) rows, where entity is
+    "artist" or "label". All rows are resolved with one join per entity type
+    against the lowercased name index, and permissions that already exist for
+    an entity are left alone."""
+    ensure_name_indexes(session, Artist, Label)
+    session.execute(
+        "CREATE TEMPORARY TABLE permission_import "
+        "(entity varchar, name varchar, url varchar) ON COMMIT DROP")
+    if len(rows) > 0:
+        session.execute(permission_import.insert(),
+            [dict(entity=entity, name=name, url=url) for entity, name, url in rows])
+
+    added = 0
+    known = 0
+    unresolved = []
+    ambiguous = []
+    for key, (entity, permission, gid_column) in PERMISSION_ENTITIES.items():
+        candidates = session.execute(
+            sqlalchemy.select([permission_import.c.name,
+                    permission_import.c.url,
+                    func.count(entity.id).label('matches'),
+                    func.min(sqlalchemy.cast(entity.gid, sqlalchemy.String)).label('gid')])
+            .select_from(permission_import.outerjoin(entity.__table__,
+                func.lower(entity.name) == func.lower(permission_import.c.name)))
+            .where(permission_import.c.entity == key)
+            .group_by(permission_import.c.name, permission_import.c.url)
+        ).fetchall()
+        resolved = []
+        for row in candidates:
+            if row.matches == 0:
+                unresolved.append("%s %r" % (key, row.name))
+            elif row.matches > 1:
+                ambiguous.append("%s %r" % (key, row.name))
+            else:
+                resolved.append({gid_column: row.gid, 'url': row.url, 'source': source})
+        if len(resolved) > 0:
+            inserted = session.execute(
+                insert(permission.__table__)
+                .values(resolved)
+                .on_conflict_do_nothing(index_elements=[gid_column])
+                .returning(permission.id)).rowcount
+            added += inserted
+            known += len(resolved) - inserted
+    session.commit()
+
+    db.app.logger.info("Imported %s permissions: %d added, %d already known, %d unresolved, %d ambiguous"
+        % (source, added, known, len(unresolved), len(ambiguous)))
+    if len(unresolved) > 0:
+        db.app.logger.error("Can't find %s" % ", ".join(unresolved))
+    if len(ambiguous) > 0:
+        db.app.logger.error("Several matches for %s" % ", ".join(ambiguous))
+
+
 def import_partybus_stream_permission():
     """Import artist streaming permissions from PartyBus's spreadsheet"""
-    with urlopen_with_ua("https://docs.google.com/spreadsheets/d/1QjLWvGHCslmupJKRn5JWnymK4Hxtq_O71JYXGw4yq5g/export?format=csv") as csvfile:
-        reader = csv.reader(codecs.iterdecode(csvfile, 'utf-8'))
+    with http_client.conditional_get("https://docs.google.com/spreadsheets/d/1QjLWvGHCslmupJKRn5JWnymK4Hxtq_O71JYXGw4yq5g/export?format=csv") as response:
+        if response is None:
+            db.app.logger.info("PartyBus's spreadsheet has not changed")
+            return
+        response.encoding = 'utf-8'
+        reader = csv.reader(io.StringIO(response.text))
         for row in reader:
             if len(row) > 0 and row[0] == "Name":
                 break
+        rows = []
         for row in reader:
             name, genre, type, whereToAcquire, platform, permission, screenshot = row
-            try:
-                if type == "Artist":
-                    e = db.session.query(Artist).filter(func.lower(
-                        Artist.name, type_=db.String) == name.lower()).one()
-                    if db.session.query(ArtistStreamPermission).filter(
-                            ArtistStreamPermission.artist_gid == e.gid).count() == 0:
-                        db.session.add(
-                            ArtistStreamPermission(
-                                artist=e,
-                                url=permission,
-                                source="PartyBus"))
-                elif type == "Label/Group":
-                    e = db.session.query(Label).filter(func.lower(
-                        Label.name, type_=db.String) == name.lower()).one()
-                    if db.session.query(LabelStreamPermission).filter(
-                            LabelStreamPermission.label_gid == e.gid).count() == 0:
-                        db.session.add(
-                            LabelStreamPermission(
-                                label=e,
-                                url=permission,
-                                source="PartyBus"))
-            except sqlalchemy.orm.exc.NoResultFound as err:
-                db.app.logger.error("Can't find %s %r: %s" % (type, name, err))
-                continue
-            except sqlalchemy.orm.exc.MultipleResultsFound as err:
-                db.app.logger.error("Can't find %s %r: %s" % (type, name, err))
-                continue
-            db.app.logger.info("Added %s %r as %s" % (type, name, e.gid))
-        db.session.commit()
+            if type == "Artist":
+                rows.append(('artist', name, permission))
+            elif type == "Label/Group":
+                rows.append(('label', name, permission))
+        import_stream_permissions(db.session, "PartyBus", rows)
 
 
 def import_creatorhype_stream_permission():
     """Import artist streaming permissions from creatorhype.com's spreadsheet"""
-    for row in json.load(urlopen_with_ua(
-            "https://creatorhype.com/wp-admin/admin-ajax.php?action=wp_ajax_ninja_tables_public_action&table_id=3665&target_action=get-all-data&default_sorting=old_first")):
-        soup = BeautifulSoup(
-            row["value"]["proof_of_permission"],
-            "html.parser")
-        if not soup or not soup.a or not soup.a['href']:
-            continue
-        name = row["value"]["source"]
-        url = soup.a['href']
-        try:
-            a = db.session.query(Artist).filter(func.lower(
-                Artist.name, type_=db.String) == name.lower()).one()
-        except sqlalchemy.orm.exc.NoResultFound as e:
-            db.app.logger.error("Can't find artist %r: %s" % (name, e))
-            continue
-        except sqlalchemy.orm.exc.MultipleResultsFound as e:
-            db.app.logger.error("Can't find artist %r: %s" % (name, e))
-            continue
-        if db.session.query(ArtistStreamPermission).filter(
-                ArtistStreamPermission.artist_gid == a.gid).count() > 0:
+    with http_client.conditional_get(
+            "https://creatorhype.com/wp-admin/admin-ajax.php?action=wp_ajax_ninja_tables_public_action&table_id=3665&target_action=get-all-data&default_sorting=old_first") as response:
+        if response is None:
+            db.app.logger.info("creatorhype.com's spreadsheet has not changed")
+            return
+        rows = []
+        for row in response.json():
+            soup = BeautifulSoup(
+                row["value"]["proof_of_permission"],
+                "html.parser")
+            if not soup or not soup.a or not soup.a['href']:
+                continue
+            rows.append(('artist', row["value"]["source"], soup.a['href']))
+        import_stream_permissions(db.session, "Creator Hype", rows)
+
+
+# Beatmaps being matched by match_with_string, created per run with
+# ON COMMIT DROP
+match_batch = sqlalchemy.Table(
+    'match_batch', sqlalchemy.MetaData(),
+    # the index of the beatmap in the batch
+    sqlalchemy.Column('beatmap', sqlalchemy.Integer),
+    sqlalchemy.Column('key', sqlalchemy.String),
+    # lowercased, for when the name keys aren't built yet
+    sqlalchemy.Column('title', sqlalchemy.String),
+    sqlalchemy.Column('artist', sqlalchemy.String))
+
+
+def choose_recordings(session, beatmaps, candidates, threshold=None):
+    """Score the candidate recordings of a batch of beatmaps together, see
+    musicgamez.scoring, and pick the best of each. candidates is a list of
+    (beatmap index, recording id, similarity) tuples. Beatmaps whose best
+    candidate scores below threshold get no match, and ones whose best
+    candidate is not clearly better than the next are marked as having
+    several matches. Returns the updates for Beatmap.__table__."""
+    config = db.app.config
+    if len(candidates) == 0:
+        return []
+    recording_ids = {recording_id for index, recording_id, similarity in candidates}
+    track_counts = sqlalchemy.select([func.count()])\
+        .select_from(Track.__table__)\
+        .where(Track.recording_id == Recording.id)\
+        .correlate(Recording.__table__)\
+        .as_scalar()
+    recordings = {id: (gid, length, track_count) for id, gid, length, track_count in
+                  session.query(Recording.id, Recording.gid, Recording.length, track_counts)
+                         .filter(Recording.id.in_(recording_ids))}
+    candidates = [candidate for candidate in candidates if candidate[1] in recordings]
+    sites = dict(session.query(BeatSite.id, BeatSite.short_name))
+    site_weights = config['SCORE_SITE_DURATION_WEIGHTS']
+
+    groups = np.array([index for index, recording_id, similarity in candidates], dtype=np.int64)
+    similarity = np.array([similarity for index, recording_id, similarity in candidates])
+    lengths = np.array([recordings[recording_id][1] or np.nan
+                        for index, recording_id, similarity in candidates], dtype=np.float64)
+    durations = np.array([beatmaps[index].duration or np.nan
+                          for index, recording_id, similarity in candidates], dtype=np.float64)
+    track_count = np.array([recordings[recording_id][2]
+                            for index, recording_id, similarity in candidates], dtype=np.float64)
+    site_weight = np.array([site_weights.get(sites[beatmaps[index].external_site_id], 1.0)
+                            for index, recording_id, similarity in candidates])
+
+    scores = score_candidates(similarity, lengths / 1000 - durations, track_count,
+                              site_weight, config['SCORE_WEIGHTS'])
+    indexes, best, best_scores, margins = best_candidates(groups, scores)
+    updates = []
+    for index, candidate, score, margin in zip(indexes, best, best_scores, margins):
+        if threshold is not None and score < threshold:
             continue
-        db.session.add(
-            ArtistStreamPermission(
-                artist=a,
-                url=url,
-                source="Creator Hype"))
-        db.app.logger.info("Added artist %r as %s" % (name, a.gid))
-    db.session.commit()
+        updates.append(dict(
+            b_id=beatmaps[index].id,
+            b_recording_gid=recordings[candidates[candidate][1]][0],
+            b_state=Beatmap.State.MATCHED_WITH_STRING if margin >= config['SCORE_AMBIGUITY_MARGIN']
+                else Beatmap.State.MATCHED_WITH_STRING_MULTIPLE))
+    return updates
+
+
+def apply_matches(session, updates):
+    """Write the matches from choose_recordings. Like every bulk update of
+    beatmaps, this goes around the ORM and invalidate_recording_detail, so
+    the cached details of the recordings they now belong to are dropped here.
+    The beatmaps weren't matched before, so those are the only recordings
+    whose beatmaps changed."""
+    if len(updates) > 0:
+        session.execute(Beatmap.__table__.update()
+            .where(Beatmap.id == sqlalchemy.bindparam('b_id'))
+            .values(recording_gid=sqlalchemy.bindparam('b_recording_gid'),
+                    state=sqlalchemy.bindparam('b_state')),
+            updates)
+    for update in updates:
+        recording_cache.pop(str(update['b_recording_gid']))
+    return {update['b_id'] for update in updates}
+
+
+def name_keys_built(session):
+    build = session.query(NameKeyBuild).get(1)
+    return build is not None and build.completed is not None
+
+
+def string_candidates(session, beatmaps):
+    """Look up the recordings with the same name key as each of a batch of
+    beatmaps, with one probe of the name key table per beatmap. Returns
+    (beatmap index, recording id, similarity) candidates for
+    choose_recordings.
+
+    Until build-name-keys has been through every recording, the name key
+    table would miss most matches, so recordings are looked up by their
+    lowercased name and artist credit instead, like before there were name
+    keys."""
+    session.execute(
+        "CREATE TEMPORARY TABLE match_batch "
+        "(beatmap integer PRIMARY KEY, key varchar, title varchar, artist varchar) "
+        "ON COMMIT DROP")
+    session.execute(match_batch.insert().values([
+        dict(beatmap=index, key=key_digest(match_key(bm.title, bm.artist)),
+             title=bm.title.lower(), artist=bm.artist.lower())
+        for index, bm in enumerate(beatmaps)]))
+    session.execute("ANALYZE match_batch")
+
+    if name_keys_built(session):
+        query = sqlalchemy.select([match_batch.c.beatmap, RecordingNameKey.recording_id])\
+            .select_from(match_batch.join(RecordingNameKey.__table__,
+                                          RecordingNameKey.key == match_batch.c.key))
+    else:
+        query = sqlalchemy.select([match_batch.c.beatmap, Recording.id])\
+            .select_from(match_batch
+                .join(Recording.__table__,
+                      func.lower(Recording.name, type_=db.String) == match_batch.c.title)
+                .join(ArtistCredit.__table__,
+                      (ArtistCredit.id == Recording.artist_credit_id) &
+                      (func.lower(ArtistCredit.name, type_=db.String) == match_batch.c.artist)))
+    # every candidate has the beatmap's names, so they are equally similar
+    return [(index, recording_id, 1.0) for index, recording_id in session.execute(query)]
 
 
 @scheduler.task('interval', id='match_with_string', seconds=10)
 def match_with_string():
+    """Match a batch of new beatmaps to recordings by title and artist, see
+    string_candidates, and choose between the recordings that match by
+    length and popularity."""
     with db.app.app_context():
-        matched = 0
         session = db.create_scoped_session()
-        total = 0
-        for bm in session.query(Beatmap)\
-                         .filter(Beatmap.state == Beatmap.State.INITIAL)\
-                         .order_by(Beatmap.last_checked)\
-                         .limit(10):
-            # TODO use normalize(nfkc) once on PosgreSQL 13
-            # TODO use aliases
-            stmt = sqlalchemy.select([func.count()])\
-                             .select_from(Track.__table__)\
-                             .where(Track.recording_id == Recording.id)\
-                             .correlate(Recording.__table__)
-            q = session.query(Recording)\
-                       .filter(func.lower(Recording.name, type_=db.String) == bm.title.lower(),
-                               Recording.artist_credit.has(func.lower(ArtistCredit.name, type_=db.String) == bm.artist.lower()))\
-                       .order_by(func.abs(Recording.length-((bm.duration or 0)*1000)), sqlalchemy.desc(stmt))\
-                       .limit(2)
-            recs = q.all()
-            if len(recs) > 0:
-                bm.recording = recs[0]
-                matched += 1
-                if len(recs) == 1:
-                    bm.state = Beatmap.State.MATCHED_WITH_STRING
-                else:
-                    bm.state = Beatmap.State.MATCHED_WITH_STRING_MULTIPLE
-            else:
-                bm.state = Beatmap.State.WAITING_FOR_FINGERPRINT
-            total += 1
-            #session.commit()
-        if matched > 0:
-            db.app.logger.info("Matched {} beatmaps using string".format(matched))
-        if total > 0:
+        start = time.monotonic()
+
+        beatmaps = session.query(Beatmap.id, Beatmap.title, Beatmap.artist,
+                                 Beatmap.duration, Beatmap.external_site_id)\
+            .filter(Beatmap.state == Beatmap.State.INITIAL)\
+            .order_by(Beatmap.last_checked)\
+            .limit(db.app.config['MATCH_BATCH_SIZE'])\
+            .all()
+        total = len(beatmaps)
+        if total == 0:
+            session.remove()
+            return
+        candidates = string_candidates(session, beatmaps)
+        matched_ids = apply_matches(session, choose_recordings(session, beatmaps, candidates))
+        matched = len(matched_ids)
+        if db.app.config['SOLR_URI'] is not None:
+            searched = match_with_search(session,
+                [bm for bm in beatmaps if bm.id not in matched_ids])
+            db.app.logger.info("Matched {} more beatmaps using search".format(searched))
+            matched += searched
+        gids = [gid for gid, in session.execute(Beatmap.__table__.update()
+            .where(Beatmap.id.in_([bm.id for bm in beatmaps]))
+            .where(Beatmap.state == Beatmap.State.INITIAL)
+            .values(state=Beatmap.State.WAITING_FOR_FINGERPRINT)
+            .returning(Beatmap.recording_gid))
+            if gid is not None]
+        session.commit()
+        for gid in gids:
+            recording_cache.pop(str(gid))
+
+        elapsed = time.monotonic() - start
+        db.app.logger.info("Matched {} of {} beatmaps using string in {:.1f}s ({:.0f} rows/s)".format(
+            matched, total, elapsed, total / elapsed))
+        session.remove()
+
+
+def match_with_search(session, beatmaps):
+    """Look for recordings similar to beatmaps that had no exact match in
+    Solr, and rescore the top candidates against all the names they are
+    known by. Beatmaps with candidates that score above
+    SEARCH_MATCH_THRESHOLD are matched, like with an exact match. Returns
+    the number of beatmaps matched."""
+    config = db.app.config
+    results = search_recordings(http_client, config['SOLR_URI'],
+        [recording_query(bm.title, bm.artist, bm.duration, config['SEARCH_DURATION_TOLERANCE'])
+         for bm in beatmaps],
+        rows=config['SEARCH_CANDIDATES'], concurrency=config['SEARCH_CONCURRENCY'])
+    recording_ids = {recording_id for result in results for recording_id in result}
+    if len(recording_ids) == 0:
+        return 0
+    names = recording_names(session, list(recording_ids))
+    candidates = [(index, recording_id, string_similarity(bm.title, bm.artist, *names[recording_id]))
+                  for index, (bm, result) in enumerate(zip(beatmaps, results))
+                  for recording_id in result]
+    return len(apply_matches(session, choose_recordings(
+        session, beatmaps, candidates, config['SEARCH_MATCH_THRESHOLD'])))
+
+
+BenchmarkBeatmap = namedtuple('BenchmarkBeatmap', ['id', 'title', 'artist', 'duration', 'external_site_id'])
+
+
+def benchmark_scoring(beatmaps=1000, query_beatmaps=100):
+    """Time matching beatmaps made up from random recordings the way
+    match_with_string does, looking up the candidates of the whole batch and
+    choosing between them with choose_recordings, against the query it used
+    to run for each beatmap. Returns the beatmaps matched per second both
+    ways. Nothing is written."""
+    rng = np.random.default_rng(0)
+    with db.app.app_context():
+        session = db.create_scoped_session()
+        max_id = session.query(func.max(Recording.id)).scalar() or 1
+        site_id = session.query(BeatSite.id).filter(BeatSite.short_name == 'bs').scalar()
+        recordings = session.query(Recording.name, ArtistCredit.name, Recording.length)\
+            .join(ArtistCredit, Recording.artist_credit_id == ArtistCredit.id)\
+            .filter(Recording.id.in_([int(id) for id in rng.integers(1, max_id + 1, 2 * beatmaps)]))\
+            .filter(Recording.length.isnot(None))\
+            .limit(beatmaps)\
+            .all()
+        # beatmap lengths are a few seconds off from the recording's
+        batch = [BenchmarkBeatmap(index, title, artist,
+                                  max(1, int(length / 1000 + rng.normal(0, 5))), site_id)
+                 for index, (title, artist, length) in enumerate(recordings)]
+
+        start = time.perf_counter()
+        choose_recordings(session, batch, string_candidates(session, batch))
+        batch_rate = len(batch) / (time.perf_counter() - start)
+        session.rollback()
+
+        track_counts = sqlalchemy.select([func.count()])\
+            .select_from(Track.__table__)\
+            .where(Track.recording_id == Recording.id)\
+            .correlate(Recording.__table__)
+        start = time.perf_counter()
+        for bm in batch[:query_beatmaps]:
+            session.query(Recording.id)\
+                   .filter(func.lower(Recording.name, type_=db.String) == bm.title.lower(),
+                           Recording.artist_credit.has(func.lower(ArtistCredit.name, type_=db.String) == bm.artist.lower()))\
+                   .order_by(func.abs(Recording.length - bm.duration * 1000), sqlalchemy.desc(track_counts))\
+                   .limit(2)\
+                   .all()
+        query_rate = min(query_beatmaps, len(batch)) / (time.perf_counter() - start)
+        session.remove()
+    return batch_rate, query_rate
+
+
+NAME_KEY_CHUNK_SIZE = 10000
+
+
+def recording_names(session, recording_ids):
+    """The titles and artists every recording in recording_ids is known by:
+    its name, aliases and track names, and the names of its and its tracks'
+    artist credits and of the credited artists and their aliases"""
+    titles = expression.union(
+        sqlalchemy.select([Recording.id, Recording.name])
+            .where(Recording.id.in_(recording_ids)),
+        sqlalchemy.select([RecordingAlias.recording_id, RecordingAlias.name])
+            .where(RecordingAlias.recording_id.in_(recording_ids)),
+        sqlalchemy.select([Track.recording_id, Track.name])
+            .where(Track.recording_id.in_(recording_ids)))
+    credits = expression.union(
+        sqlalchemy.select([Recording.id.label('recording_id'), Recording.artist_credit_id.label('artist_credit_id')])
+            .where(Recording.id.in_(recording_ids)),
+        sqlalchemy.select([Track.recording_id, Track.artist_credit_id])
+            .where(Track.recording_id.in_(recording_ids))).alias('credits')
+    credited = credits.join(ArtistCreditName.__table__,
+                            ArtistCreditName.artist_credit_id == credits.c.artist_credit_id)
+    artists = expression.union(
+        sqlalchemy.select([credits.c.recording_id, ArtistCredit.name])
+            .select_from(credits.join(ArtistCredit.__table__, ArtistCredit.id == credits.c.artist_credit_id)),
+        sqlalchemy.select([credits.c.recording_id, ArtistCreditName.name])
+            .select_from(credited),
+        sqlalchemy.select([credits.c.recording_id, Artist.name])
+            .select_from(credited.join(Artist.__table__, Artist.id == ArtistCreditName.artist_id)),
+        sqlalchemy.select([credits.c.recording_id, ArtistAlias.name])
+            .select_from(credited.join(ArtistAlias.__table__, ArtistAlias.artist_id == ArtistCreditName.artist_id)))
+    names = {recording_id: ([], []) for recording_id in recording_ids}
+    for recording_id, name in session.execute(titles):
+        names[recording_id][0].append(name)
+    for recording_id, name in session.execute(artists):
+        names[recording_id][1].append(name)
+    return names
+
+
+def build_name_keys(session, recording_ids):
+    """Replace the name keys of the recordings in recording_ids, in chunks"""
+    recording_ids = sorted(set(recording_ids))
+    for i in range(0, len(recording_ids), NAME_KEY_CHUNK_SIZE):
+        chunk = recording_ids[i:i+NAME_KEY_CHUNK_SIZE]
+        rows = [dict(key=key_digest(key), recording_id=recording_id)
+                for recording_id, (titles, artists) in recording_names(session, chunk).items()
+                for key in match_keys(titles, artists)]
+        session.execute(RecordingNameKey.__table__.delete()
+                        .where(RecordingNameKey.recording_id.in_(chunk)))
+        if len(rows) > 0:
+            session.execute(RecordingNameKey.__table__.insert().values(rows))
+        session.commit()
+
+
+def rebuild_all_name_keys(restart=False):
+    """Build the name keys of every recording, which takes a long time. An
+    interrupted build continues where it stopped, unless restart is set."""
+    with db.app.app_context():
+        session = db.create_scoped_session()
+        session.execute(last_updated_indexes)
+        build = session.query(NameKeyBuild).get(1)
+        if build is None:
+            build = NameKeyBuild(id=1, last_recording_id=0)
+            session.add(build)
+        elif restart:
+            # the old keys are good enough to keep matching with meanwhile
+            build.last_recording_id = 0
+        session.commit()
+        while True:
+            recording_ids = [recording_id for recording_id, in
+                             session.query(Recording.id)
+                                    .filter(Recording.id > build.last_recording_id)
+                                    .order_by(Recording.id)
+                                    .limit(NAME_KEY_CHUNK_SIZE)]
+            if len(recording_ids) == 0:
+                break
+            build_name_keys(session, recording_ids)
+            build.last_recording_id = recording_ids[-1]
             session.commit()
+            db.app.logger.info("Built name keys up to recording {}".format(build.last_recording_id))
+        build.completed = func.now()
+        session.commit()
+        # matching by string doesn't fall back to lowercased names anymore
+        for drop_index in drop_fallback_name_indexes:
+            session.execute(drop_index)
+        session.commit()
+        session.remove()
+
+
+def update_name_keys(since):
+    """Rebuild the name keys of recordings whose names, aliases, tracks,
+    artists or artist aliases changed after since. This relies on the
+    last_updated indexes that build-name-keys creates."""
+    with db.app.app_context():
+        session = db.create_scoped_session()
+        credits = expression.union(
+            sqlalchemy.select([ArtistCreditName.artist_credit_id])
+                .select_from(ArtistCreditName.__table__.join(Artist.__table__,
+                                                             Artist.id == ArtistCreditName.artist_id))
+                .where(Artist.last_updated > since),
+            sqlalchemy.select([ArtistCreditName.artist_credit_id])
+                .select_from(ArtistCreditName.__table__.join(ArtistAlias.__table__,
+                                                             ArtistAlias.artist_id == ArtistCreditName.artist_id))
+                .where(ArtistAlias.last_updated > since))
+        changed = expression.union(
+            sqlalchemy.select([Recording.id])
+                .where(Recording.last_updated > since),
+            sqlalchemy.select([RecordingAlias.recording_id])
+                .where(RecordingAlias.last_updated > since),
+            sqlalchemy.select([Track.recording_id])
+                .where(Track.last_updated > since),
+            sqlalchemy.select([Recording.id])
+                .where(Recording.artist_credit_id.in_(credits)),
+            sqlalchemy.select([Track.recording_id])
+                .where(Track.artist_credit_id.in_(credits)))
+        recording_ids = [recording_id for recording_id, in session.execute(changed)]
+        build_name_keys(session, recording_ids)
+        db.app.logger.info("Rebuilt name keys of {} recordings".format(len(recording_ids)))
         session.remove()
 
 
@@ -303,160 +977,486 @@ def zipopen_lower(z, fname):
     return z.open(fname)
 
 
-@scheduler.task('interval', id='generate_fingerprint', minutes=1)
-def generate_fingerprint():
+def worker_name():
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.current_thread().name)
+
+
+def claim_beatmaps(session, stage, limit, *criteria):
+    """Claim up to limit beatmaps matching criteria for a stage, that no one
+    else holds an unexpired claim on, oldest checked first. The rows are
+    locked with FOR UPDATE SKIP LOCKED while claiming, and the claims are
+    committed right away. A claim lasts CLAIM_LEASE seconds, after which
+    the beatmap goes back to the queue, in case its worker died.
+
+    The check for existing claims in the SELECT can be from before another
+    worker committed its claims, so the claims are written with an upsert
+    that only takes over expired claims. Postgres rechecks that against the
+    latest version of the claim, and only the beatmaps it returns are ours."""
+    claimed = expression.exists()\
+        .where(BeatmapClaim.beatmap_id == Beatmap.id)\
+        .where(BeatmapClaim.expires > func.now())
+    while True:
+        ids = [id for id, in session.query(Beatmap.id)
+                                    .filter(*criteria)
+                                    .filter(~claimed)
+                                    .order_by(Beatmap.last_checked)
+                                    .limit(limit)
+                                    .with_for_update(of=Beatmap, skip_locked=True)]
+        if len(ids) == 0:
+            session.commit()
+            return []
+        expires = func.now() + timedelta(seconds=db.app.config['CLAIM_LEASE'])
+        stmt = insert(BeatmapClaim.__table__).values(
+            [dict(beatmap_id=id, stage=stage, worker=worker_name(), expires=expires) for id in ids])
+        won = [id for id, in session.execute(stmt.on_conflict_do_update(
+            index_elements=[BeatmapClaim.beatmap_id],
+            set_={column: stmt.excluded[column] for column in ('stage', 'worker', 'expires')},
+            where=BeatmapClaim.__table__.c.expires <= func.now())
+            .returning(BeatmapClaim.beatmap_id))]
+        session.commit()
+        # if another worker got all of them first, look again: the next
+        # SELECT sees its claims
+        if len(won) > 0:
+            return session.query(Beatmap)\
+                .filter(Beatmap.id.in_(won))\
+                .order_by(Beatmap.last_checked)\
+                .all()
+
+
+def release_claim(session, bm):
+    """Give up the claim on a beatmap, in the same transaction as its result"""
+    session.query(BeatmapClaim)\
+        .filter(BeatmapClaim.beatmap_id == bm.id)\
+        .delete(synchronize_session=False)
+
+
+def drain(stage, claim, process):
+    """Claim and process batches of beatmaps until there are none left or
+    the run has taken CLAIM_RUN_TIME seconds, or process returns False to
+    say the next batch wouldn't fare any better. Any number of these can
+    run at once."""
     with db.app.app_context():
         session = db.create_scoped_session()
-        # TODO support osu! (download requires user grant)
-        bm = session.query(Beatmap)\
-            .filter(Beatmap.state == Beatmap.State.WAITING_FOR_FINGERPRINT)\
-            .filter(Beatmap.external_site.has(BeatSite.short_name == 'bs'))\
-            .order_by(Beatmap.last_checked)\
-            .first()
-        if bm is None and session.query(Beatmap)\
-                                 .filter(Beatmap.state == Beatmap.State.HAS_FINGERPRINT)\
-                                 .count() == 0:
-            # After all songs have a match, go back and get higher-quality
-            # matches with fingerprints
-            bm = session.query(Beatmap)\
-                 .filter(Beatmap.state == Beatmap.State.MATCHED_WITH_STRING_MULTIPLE)\
-                 .filter(Beatmap.external_site.has(BeatSite.short_name == 'bs'))\
-                 .order_by(Beatmap.last_checked)\
-                 .first()
-            if bm is None:
-                bm = session.query(Beatmap)\
-                     .filter(Beatmap.state == Beatmap.State.MATCHED_WITH_STRING)\
-                     .filter(Beatmap.external_site.has(BeatSite.short_name == 'bs'))\
-                     .order_by(Beatmap.last_checked)\
-                     .first()
-        if bm is None:
-            session.remove()
-            return
-        db.app.logger.debug(
-            "Generating fingerprint for beatmap ID {}".format(
-                bm.id))
-        try:
-            if bm.external_site.short_name == 'bs':
-                if bm.extra is not None and 'versions' in bm.extra:
-                    mapinfo = bm.extra
-                else:
-                    mapinfo = json.load(urlopen_with_ua("https://beatsaver.com/api/maps/id/" + bm.external_id))
-                dl_url = mapinfo['versions'][0]['downloadURL']
-            elif bm.external_site.short_name == 'osu':
-                dl_url = "https://osu.ppy.sh/api/v2/beatmapsets/" + bm.external_id + "/download"
-            else:
-                assert False
-            url_file = urlopen_with_ua(dl_url)
+        deadline = time.monotonic() + db.app.config['CLAIM_RUN_TIME']
+        processed = 0
+        while time.monotonic() < deadline:
+            beatmaps = claim(session)
+            if len(beatmaps) == 0:
+                break
+            keep_going = process(session, beatmaps)
+            processed += len(beatmaps)
+            if keep_going is False:
+                break
+        if processed > 0:
+            db.app.logger.info("Processed {} beatmaps in the {} stage".format(processed, stage))
+        session.remove()
+
+
+def claim_beatmaps_to_fingerprint(session):
+    # TODO support osu! (download requires user grant)
+    limit = 2 * fingerprint_engine.workers
+    is_bs = Beatmap.external_site.has(BeatSite.short_name == 'bs')
+    beatmaps = claim_beatmaps(session, 'fingerprint', limit,
+        Beatmap.state == Beatmap.State.WAITING_FOR_FINGERPRINT, is_bs)
+    if len(beatmaps) == 0 and session.query(Beatmap)\
+                                      .filter(Beatmap.state == Beatmap.State.HAS_FINGERPRINT)\
+                                      .count() == 0:
+        # After all songs have a match, go back and get higher-quality
+        # matches with fingerprints
+        beatmaps = claim_beatmaps(session, 'fingerprint', limit,
+            Beatmap.state == Beatmap.State.MATCHED_WITH_STRING_MULTIPLE, is_bs)
+        if len(beatmaps) == 0:
+            beatmaps = claim_beatmaps(session, 'fingerprint', limit,
+                Beatmap.state == Beatmap.State.MATCHED_WITH_STRING, is_bs)
+    return beatmaps
+
+
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
+
+def download_audio(bm):
+    """Download a beatmap and extract its song to a temporary file, returning
+    the file's path and the SHA-256 of the song. The caller removes the
+    file."""
+    if bm.external_site.short_name == 'bs':
+        if bm.extra is not None and 'versions' in bm.extra:
+            mapinfo = bm.extra
+        else:
+            mapinfo = http_client.get_json("https://beatsaver.com/api/maps/id/" + bm.external_id)
+        dl_url = mapinfo['versions'][0]['downloadURL']
+    elif bm.external_site.short_name == 'osu':
+        dl_url = "https://osu.ppy.sh/api/v2/beatmapsets/" + bm.external_id + "/download"
+    else:
+        assert False
+    # spool the archive to disk a chunk at a time, then copy the song out of
+    # it the same way, so no more than a chunk is ever in memory
+    with TemporaryFile() as archive:
+        with http_client.get(dl_url, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                archive.write(chunk)
+        with ZipFile(archive) as z:
             if bm.external_site.short_name == 'bs':
-                t = TemporaryFile()
-                t.write(url_file.read())
-                z = ZipFile(t)
-                url_file.close()
-                url_file = t
-                info = json.load(zipopen_lower(z, "info.dat"))
+                with zipopen_lower(z, "info.dat") as info_file:
+                    info = json.load(info_file)
                 songfile = z.open(info['_songFilename'])
             elif bm.external_site.short_name == 'osu':
-                t = TemporaryFile()
-                t.write(url_file.read())
-                z = ZipFile(t)
-                url_file.close()
-                url_file = t
                 songfile = zipopen_lower(z, "audio.mp3")
-            t = NamedTemporaryFile()
-            t.write(songfile.read())
-            t.flush()
-            songfile.close()
-            url_file.close()
-
-            # TODO change force_fpcalc to False once multiprocessing is
-            # possible
-            bm.duration, fp = fingerprint_file(t.name, force_fpcalc=True)
-            bm.fingerprint = fp.decode('ascii')
-            bm.state = Beatmap.State.HAS_FINGERPRINT
-            session.commit()
-        except Exception as e:
+            # the worker process opens the file by name, so it has to
+            # outlive this
+            t = NamedTemporaryFile(delete=False)
+            digest = hashlib.sha256()
+            try:
+                with songfile, t:
+                    for chunk in iter(lambda: songfile.read(DOWNLOAD_CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                        t.write(chunk)
+            except BaseException:
+                os.remove(t.name)
+                raise
+    return t.name, digest.hexdigest()
+
+
+def link_audio(session, bm, audio_hash):
+    stmt = insert(BeatmapAudio.__table__).values(beatmap_id=bm.id, audio_hash=audio_hash)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[BeatmapAudio.beatmap_id],
+        set_={'audio_hash': stmt.excluded.audio_hash}))
+
+
+def fresh_lookups_since():
+    """Cached AcoustID results older than this are looked up again, since
+    AcoustID keeps learning about new tracks"""
+    return datetime.now(timezone.utc) - timedelta(seconds=db.app.config['AUDIO_LOOKUP_MAX_AGE'])
+
+
+def submit_fingerprint(bm, path):
+    """Hand the song file of a beatmap to the fingerprint engine. If that
+    fails, the beatmap is left claimed to be tried again when its claim
+    expires."""
+    try:
+        return fingerprint_engine.submit(path)
+    except Exception as e:
+        db.app.logger.error(
+            "Error starting to fingerprint beatmap {}: {}".format(
+                bm.id, e))
+        return None
+
+
+def record_fingerprint(session, future, audio_hash, bms):
+    """Store the fingerprint of a song file once its worker is done with it,
+    for every beatmap of the batch that has that song"""
+    try:
+        duration, fingerprint = future.result()
+    except Exception as e:
+        for bm in bms:
             db.app.logger.error(
                 "Error generating fingerprint for beatmap {}: {}".format(
                     bm.id, e))
             bm.state = Beatmap.State.ERROR
-            session.commit()
-        session.remove()
+    else:
+        session.execute(insert(AudioFingerprint.__table__)
+            .values(hash=audio_hash, duration=duration, fingerprint=fingerprint)
+            .on_conflict_do_nothing(index_elements=[AudioFingerprint.hash]))
+        for bm in bms:
+            bm.duration = duration
+            bm.fingerprint = fingerprint
+            bm.state = Beatmap.State.HAS_FINGERPRINT
+            link_audio(session, bm, audio_hash)
+    for bm in bms:
+        release_claim(session, bm)
+    session.commit()
 
 
-@scheduler.task('interval', id='lookup_fingerprint', minutes=1)
-def lookup_fingerprint():
-    with db.app.app_context():
-        session = db.create_scoped_session()
-        bm = session.query(Beatmap)\
-            .filter(Beatmap.state == Beatmap.State.HAS_FINGERPRINT)\
-            .order_by(Beatmap.last_checked)\
-            .first()
-        if bm is None:
-            session.remove()
-            return
+def fingerprint_beatmaps(session, beatmaps):
+    """Download a batch of beatmaps and have the fingerprint engine's worker
+    processes fingerprint them. This thread only downloads, hands out files
+    and records the results, so it spends its time waiting on I/O rather
+    than holding the GIL.
+
+    Songs that were fingerprinted before, for another map or earlier in the
+    batch, aren't decoded again, and if their AcoustID results are known the
+    beatmap goes straight to its final state."""
+    pending = {}
+    hits = 0
+    for bm in beatmaps:
         db.app.logger.debug(
-            "Looking up fingerprint for beatmap ID {}".format(
+            "Generating fingerprint for beatmap ID {}".format(
                 bm.id))
         try:
-            response = lookup(
-                db.app.config.get('ACOUSTID_API_KEY'),
-                bm.fingerprint,
-                bm.duration,
-                timeout=30)
-            if response['status'] != 'ok':
-                db.app.logger.debug("{}".format(response))
-                raise WebServiceError("status: %s" % response['status'])
-            if 'results' not in response:
-                db.app.logger.debug("{}".format(response))
-                raise WebServiceError("results not included")
-
-            if len(response['results']) == 0:
-                bm.state = Beatmap.State.NO_MATCH
-                db.app.logger.debug("No matches for beatmap {}".format(bm.id))
-                session.commit()
-                session.remove()
-                return
-            elif len(response['results']) > 1:
-                db.app.logger.warning(
-                    "Beatmap {} has more than one track ID, using first".format(
-                        bm.id))
-
-            track = response['results'][0]
-            bm.track_id = track['id']
-            if 'recordings' not in track or len(track['recordings']) == 0:
-                bm.state = Beatmap.State.NO_MATCH
-                db.app.logger.debug(
-                    "No matches for beatmap {} track {}".format(
-                        bm.id, bm.track_id))
-            elif len(track['recordings']) == 1:
-                gid = track['recordings'][0]['id']
-                redir = session.query(RecordingGIDRedirect).filter(RecordingGIDRedirect.gid==gid).one_or_none()
-                if redir is not None:
-                    gid = redir.redirect.gid
-                if session.query(Recording).filter(Recording.gid==gid).count() == 0:
-                    bm.state = Beatmap.State.NO_MATCH
-                    db.app.logger.warning(
-                        "Match beatmap {} track {} recording {} not found".format(
-                            bm.id, bm.track_id, gid))
-                else:
-                    bm.recording_gid = gid
-                    bm.state = Beatmap.State.MATCHED_WITH_FINGERPRINT
-                    db.app.logger.info(
-                        "Matched beatmap {} with recording {}".format(
-                            bm.id, bm.recording_gid))
+            path, audio_hash = download_audio(bm)
+        except Exception as e:
+            db.app.logger.error(
+                "Error downloading beatmap {}: {}".format(
+                    bm.id, e))
+            bm.state = Beatmap.State.ERROR
+            release_claim(session, bm)
+            session.commit()
+            continue
+        if audio_hash in pending:
+            os.remove(path)
+            pending[audio_hash][2].append(bm)
+            hits += 1
+            continue
+        cached = session.query(AudioFingerprint).get(audio_hash)
+        if cached is not None:
+            os.remove(path)
+            hits += 1
+            bm.duration = cached.duration
+            bm.fingerprint = cached.fingerprint
+            link_audio(session, bm, audio_hash)
+            if cached.lookup is not None and cached.looked_up > fresh_lookups_since():
+                apply_lookups(session, [bm], [cached.lookup])
             else:
-                bm.state = Beatmap.State.TOO_MANY_MATCHES
-                db.app.logger.debug(
-                    "Too many matches for beatmap {} track {}".format(
-                        bm.id, bm.track_id))
+                bm.state = Beatmap.State.HAS_FINGERPRINT
+            release_claim(session, bm)
             session.commit()
+            continue
+        # fingerprint this one while the next one downloads
+        future = submit_fingerprint(bm, path)
+        if future is None:
+            os.remove(path)
+            continue
+        pending[audio_hash] = (future, path, [bm])
+
+    futures = {future: (audio_hash, path, bms)
+               for audio_hash, (future, path, bms) in pending.items()}
+    broken = []
+    for future in as_completed(futures):
+        audio_hash, path, bms = futures[future]
+        if isinstance(future.exception(), BrokenProcessPool):
+            broken.append((audio_hash, path, bms))
+            continue
+        try:
+            record_fingerprint(session, future, audio_hash, bms)
+        finally:
+            os.remove(path)
+
+    # A worker that dies fails everything that was in the pool with it.
+    # Fingerprint those files again one at a time, on a new pool, so only a
+    # file that kills a worker by itself ends up in the error state.
+    for audio_hash, path, bms in broken:
+        try:
+            future = submit_fingerprint(bms[0], path)
+            if future is not None:
+                record_fingerprint(session, future, audio_hash, bms)
+        finally:
+            os.remove(path)
+
+    hit_rate = fingerprint_engine.record_cache('fingerprint', hits, len(pending))
+    if hits > 0:
+        db.app.logger.info("Reused the fingerprints of {} of {} beatmaps ({:.0%} overall)".format(
+            hits, hits + len(pending), hit_rate))
+
+
+@scheduler.task('interval', id='generate_fingerprint', minutes=1)
+def generate_fingerprint():
+    drain('fingerprint', claim_beatmaps_to_fingerprint, fingerprint_beatmaps)
+
+
+# AcoustID error codes, see https://acoustid.org/webservice
+# ones that go away by themselves, so the beatmaps should be tried again later
+ACOUSTID_TRANSIENT_ERRORS = {
+    5,   # internal error
+    13,  # service unavailable
+    14,  # too many requests
+}
+# ones about a single fingerprint of the request
+ACOUSTID_FINGERPRINT_ERRORS = {
+    3,   # invalid fingerprint
+    8,   # invalid duration
+}
+
+
+def lookup_fingerprints(beatmaps):
+    """Look up the fingerprints of several beatmaps with one request to the
+    AcoustID web service, which goes through the HTTP client's rate limit
+    for its host. Returns the results for each beatmap, or None for ones
+    the service gave no results for."""
+    data = {'client': db.app.config.get('ACOUSTID_API_KEY'),
+            'meta': 'recordings',
+            'format': 'json'}
+    for i, bm in enumerate(beatmaps):
+        data['fingerprint.{}'.format(i)] = bm.fingerprint
+        data['duration.{}'.format(i)] = str(int(bm.duration))
+    response = http_client.post(db.app.config['ACOUSTID_API_URI'], data=data)
+    try:
+        body = response.json()
+    except ValueError:
+        response.raise_for_status()
+        raise WebServiceError("response is not JSON")
+    if body.get('status') != 'ok':
+        db.app.logger.debug("{}".format(body))
+        error = body.get('error') or {}
+        e = WebServiceError("status: {}, error {}: {}".format(
+            body.get('status'), error.get('code'), error.get('message')))
+        e.code = error.get('code')
+        raise e
+    results = [None] * len(beatmaps)
+    for fingerprint in body.get('fingerprints', []):
+        if 'results' in fingerprint:
+            results[int(fingerprint['index'])] = fingerprint['results']
+    return results
+
+
+def apply_lookups(session, beatmaps, results):
+    """Move looked up beatmaps to their next state: matched if their track
+    has exactly one recording that we have, and otherwise no match, too many
+    matches or an error. Recording redirects and existence are checked for
+    the whole batch at once."""
+    gids = {gid for gid in map(single_recording, results) if gid is not None}
+    redirects = dict(session.query(RecordingGIDRedirect.gid, Recording.gid)
+                            .join(RecordingGIDRedirect.redirect)
+                            .filter(RecordingGIDRedirect.gid.in_(gids))) if gids else {}
+    gids = {redirects.get(gid, gid) for gid in gids}
+    known = {gid for gid, in session.query(Recording.gid)
+                                    .filter(Recording.gid.in_(gids))} if gids else set()
+
+    for bm, result in zip(beatmaps, results):
+        try:
+            apply_lookup(bm, result, redirects, known)
         except Exception as e:
             db.app.logger.error(
                 "Error looking up fingerprint for beatmap {}: {}".format(
                     bm.id, e))
             bm.state = Beatmap.State.ERROR
-            session.commit()
-        session.remove()
+
+
+def single_recording(result):
+    """The recording of a lookup result whose track has just one, if it is
+    well-formed enough to tell"""
+    try:
+        recordings = result[0]['recordings']
+        return recordings[0]['id'] if len(recordings) == 1 else None
+    except (LookupError, TypeError):
+        return None
+
+
+def apply_lookup(bm, result, redirects, known):
+    if result is None:
+        raise WebServiceError("results not included")
+    if len(result) == 0:
+        bm.state = Beatmap.State.NO_MATCH
+        db.app.logger.debug("No matches for beatmap {}".format(bm.id))
+        return
+    elif len(result) > 1:
+        db.app.logger.warning(
+            "Beatmap {} has more than one track ID, using first".format(
+                bm.id))
+
+    track = result[0]
+    bm.track_id = track['id']
+    if 'recordings' not in track or len(track['recordings']) == 0:
+        bm.state = Beatmap.State.NO_MATCH
+        db.app.logger.debug(
+            "No matches for beatmap {} track {}".format(
+                bm.id, bm.track_id))
+    elif len(track['recordings']) == 1:
+        gid = track['recordings'][0]['id']
+        gid = redirects.get(gid, gid)
+        if gid not in known:
+            bm.state = Beatmap.State.NO_MATCH
+            db.app.logger.warning(
+                "Match beatmap {} track {} recording {} not found".format(
+                    bm.id, bm.track_id, gid))
+        else:
+            bm.recording_gid = gid
+            bm.state = Beatmap.State.MATCHED_WITH_FINGERPRINT
+            db.app.logger.info(
+                "Matched beatmap {} with recording {}".format(
+                    bm.id, bm.recording_gid))
+    else:
+        bm.state = Beatmap.State.TOO_MANY_MATCHES
+        db.app.logger.debug(
+            "Too many matches for beatmap {} track {}".format(
+                bm.id, bm.track_id))
+
+
+def lookup_beatmaps(session, beatmaps):
+    """Look up a batch of beatmaps, reusing AcoustID results for songs that
+    were looked up recently. Returns False when the service can't be used
+    right now, leaving the beatmaps claimed."""
+    hashes = dict(session.query(BeatmapAudio.beatmap_id, BeatmapAudio.audio_hash)
+                         .filter(BeatmapAudio.beatmap_id.in_([bm.id for bm in beatmaps])))
+    cached = dict(session.query(AudioFingerprint.hash, AudioFingerprint.lookup)
+                         .filter(AudioFingerprint.hash.in_(set(hashes.values())))
+                         .filter(AudioFingerprint.lookup.isnot(None))
+                         .filter(AudioFingerprint.looked_up > fresh_lookups_since()))
+    reused = [bm for bm in beatmaps if hashes.get(bm.id) in cached]
+    beatmaps = [bm for bm in beatmaps if hashes.get(bm.id) not in cached]
+    if len(reused) > 0:
+        apply_lookups(session, reused, [cached[hashes[bm.id]] for bm in reused])
+        session.query(BeatmapClaim)\
+            .filter(BeatmapClaim.beatmap_id.in_([bm.id for bm in reused]))\
+            .delete(synchronize_session=False)
+        session.commit()
+    hit_rate = fingerprint_engine.record_cache('lookup', len(reused), len(beatmaps))
+    if len(reused) > 0:
+        db.app.logger.info("Reused the AcoustID results of {} of {} beatmaps ({:.0%} overall)".format(
+            len(reused), len(reused) + len(beatmaps), hit_rate))
+    if len(beatmaps) == 0:
+        return True
+    return lookup_uncached(session, beatmaps, hashes)
+
+
+def lookup_uncached(session, beatmaps, hashes):
+    """Look up beatmaps with the AcoustID web service and store the results
+    for their songs. When the request fails because of some of the beatmaps,
+    they are looked up one at a time to find out which."""
+    try:
+        results = lookup_fingerprints(beatmaps)
+    except requests.RequestException as e:
+        # leave them claimed, they'll be tried again when the claims expire,
+        # and stop draining since the next batch would fail the same way
+        db.app.logger.warning(
+            "Error looking up fingerprints for {} beatmaps: {}".format(
+                len(beatmaps), e))
+        return False
+    except Exception as e:
+        code = getattr(e, 'code', None)
+        if isinstance(e, WebServiceError) and code not in ACOUSTID_FINGERPRINT_ERRORS:
+            # the service or our request is at fault rather than the
+            # beatmaps, leave them claimed like on a transport error
+            log = db.app.logger.warning if code in ACOUSTID_TRANSIENT_ERRORS else db.app.logger.error
+            log("Error looking up fingerprints for {} beatmaps: {}".format(len(beatmaps), e))
+            return False
+        if len(beatmaps) > 1:
+            # one bad fingerprint, or one result we can't read, fails the
+            # whole request, so find out which
+            db.app.logger.info(
+                "Looking up {} beatmaps one at a time after: {}".format(len(beatmaps), e))
+            for bm in beatmaps:
+                if not lookup_uncached(session, [bm], hashes):
+                    return False
+            return True
+        db.app.logger.error(
+            "Error looking up fingerprints for beatmaps {}: {}".format(
+                ", ".join(str(bm.id) for bm in beatmaps), e))
+        for bm in beatmaps:
+            bm.state = Beatmap.State.ERROR
+    else:
+        apply_lookups(session, beatmaps, results)
+        lookups = [dict(b_hash=hashes[bm.id], b_lookup=result)
+                   for bm, result in zip(beatmaps, results)
+                   if result is not None and bm.id in hashes]
+        if len(lookups) > 0:
+            session.execute(AudioFingerprint.__table__.update()
+                .where(AudioFingerprint.hash == sqlalchemy.bindparam('b_hash'))
+                .values(lookup=sqlalchemy.bindparam('b_lookup'), looked_up=func.now()),
+                lookups)
+    session.query(BeatmapClaim)\
+        .filter(BeatmapClaim.beatmap_id.in_([bm.id for bm in beatmaps]))\
+        .delete(synchronize_session=False)
+    session.commit()
+    return True
+
+
+@scheduler.task('interval', id='lookup_fingerprint', minutes=1)
+def lookup_fingerprint():
+    drain('lookup',
+          lambda session: claim_beatmaps(session, 'lookup', db.app.config['LOOKUP_BATCH_SIZE'],
+                                         Beatmap.state == Beatmap.State.HAS_FINGERPRINT),
+          lookup_beatmaps)
 
 
 @scheduler.task('cron', id='mbsync', minute=2, second=0, jitter=30)
@@ -466,6 +1466,11 @@ def mbsync():
         config_paths.append(os.environ["MBSLAVE_CONFIG"])
     args = Namespace()
     args.keep_running = False
+    with db.app.app_context():
+        session = db.create_scoped_session()
+        # the time of the last replication packet, in MusicBrainz's clock
+        since = session.query(ReplicationControl.last_replication_date).scalar()
+        session.remove()
     try:
         mbslave_sync_main(Config(config_paths), args)
     except psycopg2.errors.ForeignKeyViolation:
@@ -480,15 +1485,29 @@ def mbsync():
             session.execute("ALTER TABLE public.beatmap ADD CONSTRAINT beatmap_recording_gid_fkey FOREIGN KEY (recording_gid) REFERENCES musicbrainz.recording(gid)")
             session.commit()
             session.remove()
+    if since is not None:
+        # rows are replicated with the time they changed on MusicBrainz, a
+        # little before the packet they are in was made
+        update_name_keys(since - timedelta(hours=1))
+    recording_cache.clear()
 
 
 @scheduler.task('interval', id='update_mini_recording_view', minutes=15)
 def update_mini_recording_view():
     with db.app.app_context():
         session = db.create_scoped_session()
+        session.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY recording_cover_view")
         session.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mini_recording_view")
+        session.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY recording_release_view")
+        session.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY recording_label_view")
+        session.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY recording_tag_view")
         session.commit()
         session.remove()
+        stats = page_cache.stats()
+        page_cache.clear()
+        db.app.logger.info(
+            "Cleared page cache ({} hits, {} misses, {} entries)".format(
+                stats["hits"], stats["misses"], stats["size"]))
 
 
 @scheduler.task('interval', id='update_genre_cloud', minutes=60)
@@ -497,39 +1516,5 @@ def update_genre_cloud():
         session = db.create_scoped_session()
         session.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY genre_cloud")
         session.commit()
+        load_genre_cloud(session)
         session.remove()
-
-TRACKING_URI = 'https://ssl.google-analytics.com/batch'
-
-def report(
-        tracking_id: str, payloads,
-        extra_headers=None,
-        **extra_data):
-    """Actually report measurements to Google Analytics."""
-    data = '\r\n'.join(_finalize_payloads(
-            tracking_id, payloads, **extra_data))
-    return requests.post(
-        TRACKING_URI, data=data, headers=extra_headers, timeout=5.0)
-
-def _finalize_payloads(
-        tracking_id: str, payloads,
-        **extra_data):
-    """Get final data for API requests for Google Analytics.
-    Updates payloads setting required non-specific values on data.
-    """
-    extra_payload = {
-        'v': '1', 'tid': tracking_id, 'aip': '1'}
-
-    for payload in payloads:
-        final_payload = dict(payload)
-        final_payload.update(extra_payload)
-        final_payload.update(extra_data)
-        yield urlencode(final_payload)
-
-@scheduler.task('interval', id='send_reports', seconds=10)
-def send_reports():
-    if 'GOOGLE_ANALYTICS_TRACKING_ID' not in db.app.config: return
-    myevents, db.app.events = db.app.events, []
-    for i in range(0, len(myevents), 20):
-        report(db.app.config['GOOGLE_ANALYTICS_TRACKING_ID'], myevents[i:i+20])
-
@@ -1,5 +1,7 @@
+from datetime import date, datetime
 from flask import abort
 from flask import Blueprint
+from flask import current_app
 from flask import g
 from flask import make_response
 from flask import redirect
@@ -7,21 +9,52 @@ from flask import render_template
 from flask import request
 from flask import session
 from flask import url_for
-from flask_babel import _
+from flask_babel import _, get_locale
 from flask_cachecontrol import cache, cache_for
 from flask_sqlalchemy import Pagination
+from functools import wraps
 import json
 from mbdata.models import *
-from musicgamez import db, translate_artist
+from musicgamez import db, genre_cloud_cache, page_cache, recording_cache
+from musicgamez import preload_translations, translate_artist
 from musicgamez.main.models import *
 import oauthlib
+import random
 import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import func, expression
+from types import SimpleNamespace
 from urllib.parse import urlparse, urlunparse
 
 bp = Blueprint("main", __name__)
 
 
+def cached_page(f):
+    """Serve GET requests for a list view from the rendered page cache, which
+    is cleared whenever the materialized views are refreshed"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if request.method != "GET":
+            return f(*args, **kwargs)
+        key = (request.endpoint,
+               tuple(sorted(request.view_args.items())),
+               tuple(sorted(request.args.items(multi=True))),
+               request.cookies.get("game"),
+               request.cookies.get("streamsafe"),
+               str(get_locale()))
+        cached = page_cache.get(key)
+        if cached is not None:
+            data, mimetype = cached
+            return current_app.response_class(data, mimetype=mimetype)
+        resp = make_response(f(*args, **kwargs))
+        # don't cache responses that correct the filter cookies
+        if resp.status_code == 200 and "Set-Cookie" not in resp.headers:
+            page_cache.set(key, (resp.get_data(), resp.mimetype))
+        return resp
+    return wrapper
+
+
 def recordinglist(q, page, pagetitle, pagelink=None, paginate=None):
     if "game" in session: del session["game"]
     if "streamsafe" in session: del session["streamsafe"]
@@ -55,54 +88,123 @@ def recordinglist(q, page, pagetitle, pagelink=None, paginate=None):
             game = None
             resp.set_cookie("game", max_age=0)
         else:
-            q = q.join(Beatmap).filter(Beatmap.external_site==site)
-    q = q.order_by(MiniRecordingView.date.desc())
+            q = q.filter(MiniRecordingView.beatmaps.any(Beatmap.external_site==site))
+    q = q.options(*recordinglist_options())
     if paginate is None:
-        q = q.paginate(page, db.app.config["PERPAGE"], True)
-        paginate = q
-        items = q.items
+        items, prev_url, next_url = keyset_paginate(q, page)
     else:
-        items = q
+        items = q.order_by(MiniRecordingView.date.desc()).all()
+        prev_url = url_for(request.endpoint, **dict(request.view_args, page=paginate.prev_num)) if paginate.has_prev else None
+        next_url = url_for(request.endpoint, **dict(request.view_args, page=paginate.next_num)) if paginate.has_next else None
+    preload_translations([recording.id for recording in items],
+        [recording.artist_credit_id for recording in items])
     resp.data = render_template("recordinglist.html", recordings=items,
-        has_next=paginate.has_next, has_prev=paginate.has_prev,
-        next_num=paginate.next_num, prev_num=paginate.prev_num,
+        prev_url=prev_url, next_url=next_url,
         pagetitle=pagetitle, pagelink=pagelink,
         games=db.session.query(BeatSite), streamsafe=streamsafe,
         filtergame=game)
     return resp
 
 
+def parse_cursor(cursor):
+    try:
+        timestamp, id = cursor.rsplit(",", 1)
+        return datetime.fromisoformat(timestamp), int(id)
+    except ValueError:
+        abort(400)
+
+
+def make_cursor(recording):
+    return "{},{}".format(recording.date.isoformat(), recording.id)
+
+
+def keyset_paginate(q, page):
+    """Fetch one page of recordings, newest first, seeking from the
+    (date, id) cursor in the "before" or "after" query argument instead of
+    counting and skipping rows, so that deep pages are as cheap as the first"""
+    perpage = db.app.config["PERPAGE"]
+    key = sqlalchemy.tuple_(MiniRecordingView.date, MiniRecordingView.id)
+    if "after" in request.args:
+        # walk backwards towards newer recordings, then flip the page around
+        items = q.filter(key > sqlalchemy.tuple_(*parse_cursor(request.args["after"])))\
+            .order_by(MiniRecordingView.date, MiniRecordingView.id)\
+            .limit(perpage+1)\
+            .all()
+        has_prev = len(items) > perpage
+        items = items[perpage-1::-1]
+        has_next = True
+    else:
+        q = q.order_by(MiniRecordingView.date.desc(), MiniRecordingView.id.desc())
+        if "before" in request.args:
+            q = q.filter(key < sqlalchemy.tuple_(*parse_cursor(request.args["before"])))
+            has_prev = True
+        elif page > 1:
+            # numbered pages are only kept so that old links keep working
+            q = q.offset((page-1)*perpage)
+            has_prev = True
+        else:
+            has_prev = False
+        items = q.limit(perpage+1).all()
+        has_next = len(items) > perpage
+        items = items[:perpage]
+    if len(items) == 0:
+        if has_prev:
+            abort(404)
+        return items, None, None
+    prev_url = url_for(request.endpoint, **dict(request.view_args, page=1, after=make_cursor(items[0]))) if has_prev else None
+    next_url = url_for(request.endpoint, **dict(request.view_args, page=1, before=make_cursor(items[-1]))) if has_next else None
+    return items, prev_url, next_url
+
+
 @bp.route("/", methods={'GET', 'POST'})
 @bp.route("/latest", defaults={"page": 1}, methods={'GET', 'POST'})
 @bp.route("/latest/<int:page>", methods={'GET', 'POST'})
 @cache(s_maxage=7.5*60)
+@cached_page
 def latest(page=1):
     return recordinglist(db.session.query(MiniRecordingView), page, _("Latest"))
 
 
+def load_genre_cloud(session):
+    """Compute the genre names and font sizes from the genre_cloud view and
+    keep them until it is next refreshed"""
+    genres = session.query(GenreCloud.name, GenreCloud.count).all()
+    if len(genres) > 0:
+        mn = min(count for name, count in genres)
+        mx = max(count for name, count in genres)
+    if len(genres) == 0 or mx == mn:
+        names_and_sizes = [(name, 40) for name, count in genres]
+    else:
+        names_and_sizes = [(name, (64 * (count - mn) / (mx - mn)) + 8) for name, count in genres]
+    genre_cloud_cache.set("genres", names_and_sizes)
+    return names_and_sizes
+
+
 @bp.route("/browse/genre")
 @cache(max_age=1*60*60, public=True)
 def genres():
-    genres = db.session.query(GenreCloud)\
-        .order_by(func.random())\
-        .all()
-    mn = min([genre.count for genre in genres])
-    mx = max([genre.count for genre in genres])
-    names_and_sizes = [(genre.name, (64 * (genre.count - mn) / (mx - mn)) + 8) for genre in genres]
-    return render_template("genres.html", genres=names_and_sizes)
+    names_and_sizes = genre_cloud_cache.get("genres")
+    if names_and_sizes is None:
+        names_and_sizes = load_genre_cloud(db.session)
+    return render_template("genres.html", genres=random.sample(names_and_sizes, len(names_and_sizes)))
+
+
+def browse(column, id):
+    """Recordings linked to a release, release group, label or tag, through
+    the precomputed view column belongs to"""
+    return db.session.query(MiniRecordingView)\
+        .filter(MiniRecordingView.id.in_(
+            db.session.query(column.class_.recording_id)
+            .filter(column == id)))
 
 
 @bp.route("/tag/<tag>", defaults={"page": 1}, methods={'GET', 'POST'})
 @bp.route("/tag/<tag>/<int:page>", methods={'GET', 'POST'})
 @cache(s_maxage=7.5*60)
+@cached_page
 def tag(tag, page=1):
-    return recordinglist(db.session.query(MiniRecordingView)
-                         .join(Track)
-                         .join(Medium)
-                         .join(Release)
-                         .join(ReleaseTag)
-                         .join(Tag)
-                         .filter(Tag.name == tag),
+    t = db.session.query(Tag).filter(Tag.name == tag).one()
+    return recordinglist(browse(RecordingTagView.tag_id, t.id),
                          page, tag,
                          "https://musicbrainz.org/tag/"+tag)
 
@@ -110,11 +212,10 @@ def tag(tag, page=1):
 @bp.route("/release/<uuid:gid>", defaults={"page": 1}, methods={'GET', 'POST'})
 @bp.route("/release/<uuid:gid>/<int:page>", methods={'GET', 'POST'})
 @cache(s_maxage=7.5*60)
+@cached_page
 def release(gid, page=1):
     r = db.session.query(Release).filter(Release.gid == str(gid)).one()
-    return recordinglist(db.session.query(MiniRecordingView)
-                         .join(Track).join(Medium)
-                         .filter(Medium.release == r), page,
+    return recordinglist(browse(RecordingReleaseView.release_id, r.id), page,
                          r.name,
                          "https://musicbrainz.org/release/"+str(gid))
 
@@ -122,6 +223,7 @@ def release(gid, page=1):
 @bp.route("/artist/<uuid:gid>", defaults={"page": 1}, methods={'GET', 'POST'})
 @bp.route("/artist/<uuid:gid>/<int:page>", methods={'GET', 'POST'})
 @cache(s_maxage=7.5*60)
+@cached_page
 def artist(gid, page=1):
     a = db.session.query(Artist).filter(Artist.gid == str(gid)).one()
     return recordinglist(db.session.query(MiniRecordingView)
@@ -134,11 +236,10 @@ def artist(gid, page=1):
 @bp.route("/label/<uuid:gid>", defaults={"page": 1}, methods={'GET', 'POST'})
 @bp.route("/label/<uuid:gid>/<int:page>", methods={'GET', 'POST'})
 @cache(s_maxage=7.5*60)
+@cached_page
 def label(gid, page=1):
     l = db.session.query(Label).filter(Label.gid == str(gid)).one()
-    return recordinglist(db.session.query(MiniRecordingView)
-                         .join(Track).join(Medium).join(Release).join(ReleaseLabel)
-                         .filter(ReleaseLabel.label == l), page,
+    return recordinglist(browse(RecordingLabelView.label_id, l.id), page,
                          l.name,
                          "https://musicbrainz.org/label/"+str(gid))
 
@@ -146,11 +247,10 @@ def label(gid, page=1):
 @bp.route("/release-group/<uuid:gid>", defaults={"page": 1}, methods={'GET', 'POST'})
 @bp.route("/release-group/<uuid:gid>/<int:page>", methods={'GET', 'POST'})
 @cache(s_maxage=7.5*60)
+@cached_page
 def release_group(gid, page=1):
     r = db.session.query(ReleaseGroup).filter(ReleaseGroup.gid == str(gid)).one()
-    return recordinglist(db.session.query(MiniRecordingView)
-                         .join(Track).join(Medium).join(Release).join(ReleaseGroup)
-                         .filter(ReleaseGroup.id == r.id), page,
+    return recordinglist(browse(RecordingReleaseView.release_group_id, r.id), page,
                          r.name,
                          "https://musicbrainz.org/release-group/"+str(gid))
 
@@ -280,28 +380,44 @@ def mycollection():
         mb_collections=mb_collections, spotify_playlists=spotify_playlists)
 
 
-@bp.route("/recording/<uuid:gid>")
-@cache(max_age=1*60, public=True)
-def recording(gid):
-    rec = db.session.query(Recording).filter(Recording.gid == str(gid)).one()
-    covers = db.session.query(CoverArt)\
-        .join(Release)\
-        .join(Medium)\
-        .join(Track)\
-        .join(CoverArtType)\
-        .join(ArtType)\
-        .filter(Track.recording == rec)\
-        .filter(ArtType.gid == 'ac337166-a2b3-340c-a0b4-e2b00f1d40a2')\
-        .order_by(func.random())\
-        .limit(5)\
-        .all()
-    rec_licenses = db.session.query(URL)\
+def json_rows(query, name):
+    """A scalar subquery that aggregates every row of query into a JSON array
+    of objects"""
+    return sqlalchemy.select([func.coalesce(
+            func.json_agg(expression.literal_column(name)),
+            expression.literal_column("'[]'::json"))])\
+        .select_from(query.subquery(name))\
+        .as_scalar()\
+        .label(name)
+
+
+def load_recording_detail(gid):
+    """Gather everything recording.html shows about a recording in two
+    queries: one for the recording with its credits and beatmaps, and one
+    for covers, licenses, permissions and links. The result holds no ORM
+    objects, so it can be cached across requests and sessions."""
+    rec = db.session.query(Recording)\
+        .options(joinedload(Recording.artist_credit)
+                     .joinedload(ArtistCredit.artists)
+                     .joinedload(ArtistCreditName.artist)
+                     .joinedload(Artist.gender),
+                 joinedload(Recording.beatmaps))\
+        .filter(Recording.gid == gid)\
+        .one()
+    covers = db.session.query(RecordingCoverView.cover_art_id.label("id"),
+                              RecordingCoverView.release_gid.label("release_gid"),
+                              RecordingCoverView.release_name.label("release_name"))\
+        .filter(RecordingCoverView.recording_id == rec.id)\
+        .order_by(RecordingCoverView.rank)\
+        .limit(5)
+    rec_licenses = db.session.query(URL.url.label("url"))\
         .join(LinkRecordingURL)\
         .join(Link)\
         .join(LinkType)\
-        .filter(LinkRecordingURL.recording == rec)\
+        .filter(LinkRecordingURL.recording_id == rec.id)\
         .filter(LinkType.gid == 'f25e301d-b87b-4561-86a0-5d2df6d26c0a')
-    rel_licenses = db.session.query(Release, URL)\
+    rel_licenses = db.session.query(Release.name.label("release_name"),
+                                    URL.url.label("url"))\
         .select_from(URL)\
         .join(LinkReleaseURL)\
         .join(Link)\
@@ -309,32 +425,34 @@ def recording(gid):
         .join(Release)\
         .join(Medium)\
         .join(Track)\
-        .filter(Track.recording == rec)\
+        .filter(Track.recording_id == rec.id)\
         .filter(LinkType.gid == '004bd0c3-8a45-4309-ba52-fa99f3aa3d50')
-    artist_perms = db.session.query(Artist, ArtistStreamPermission)\
+    artist_perms = db.session.query(Artist.id.label("id"),
+                                    Artist.name.label("name"),
+                                    ArtistStreamPermission.url.label("url"))\
         .select_from(ArtistStreamPermission)\
         .join(Artist)\
         .join(ArtistCreditName)\
-        .join(ArtistCredit)\
-        .filter(ArtistCredit.id == rec.artist_credit_id)\
+        .filter(ArtistCreditName.artist_credit_id == rec.artist_credit_id)\
         .distinct(Artist.id)
-    label_perms = db.session.query(Release, Label, LabelStreamPermission)\
+    label_perms = db.session.query(Label.name.label("name"),
+                                   LabelStreamPermission.url.label("url"))\
                     .select_from(LabelStreamPermission)\
                     .join(Label)\
                     .join(ReleaseLabel)\
                     .join(Release)\
                     .join(Medium)\
                     .join(Track)\
-                    .filter(Track.recording == rec)\
+                    .filter(Track.recording_id == rec.id)\
                     .distinct(Label.id)
-    links = db.session.query(URL, LinkType)\
+    links = db.session.query(URL.url.label("url"), LinkType.link_phrase.label("link_phrase"))\
         .select_from(URL)\
         .join(LinkRecordingURL)\
         .join(Link)\
         .join(LinkType)\
-        .filter(LinkRecordingURL.recording==rec)\
+        .filter(LinkRecordingURL.recording_id == rec.id)\
         .filter(LinkType.gid != 'f25e301d-b87b-4561-86a0-5d2df6d26c0a')\
-        .union(db.session.query(URL, LinkType)\
+        .union(db.session.query(URL.url.label("url"), LinkType.link_phrase.label("link_phrase"))\
             .select_from(URL)\
             .join(LinkReleaseURL)\
             .join(Link)\
@@ -342,29 +460,106 @@ def recording(gid):
             .join(Release)\
             .join(Medium)\
             .join(Track)\
-            .filter(Track.recording == rec)\
+            .filter(Track.recording_id == rec.id)\
             .filter(LinkType.gid != '004bd0c3-8a45-4309-ba52-fa99f3aa3d50')
         )\
         .order_by(LinkType.link_phrase)\
         .distinct()
-    selfpublish = db.session.query("157afde4-4bf5-4039-8ad2-5a15acc85176" == expression.all_(db.session.query(Label.gid)\
+    selfpublish = ("157afde4-4bf5-4039-8ad2-5a15acc85176" == expression.all_(db.session.query(Label.gid)\
                         .select_from(Track)\
                         .join(Medium)\
                         .join(Release)\
                         .outerjoin(ReleaseLabel)\
                         .outerjoin(Label)\
-                        .filter(Track.recording == rec).subquery())).one_or_none()
-    selfpublish = False if selfpublish is None else selfpublish[0]
+                        .filter(Track.recording_id == rec.id).subquery())).label("selfpublish")
+    row = db.session.query(json_rows(covers, "covers"),
+                           json_rows(rec_licenses, "rec_licenses"),
+                           json_rows(rel_licenses, "rel_licenses"),
+                           json_rows(artist_perms, "artist_perms"),
+                           json_rows(label_perms, "label_perms"),
+                           json_rows(links, "links"),
+                           selfpublish)\
+        .one()
+
+    return SimpleNamespace(
+        recording=SimpleNamespace(
+            id=rec.id,
+            gid=rec.gid,
+            name=rec.name,
+            length=rec.length,
+            artist_credit_id=rec.artist_credit_id,
+            artist_credit=SimpleNamespace(artists=[SimpleNamespace(
+                artist_id=credit.artist_id,
+                name=credit.name,
+                join_phrase=credit.join_phrase,
+                artist=SimpleNamespace(
+                    gid=credit.artist.gid,
+                    gender=SimpleNamespace(name=credit.artist.gender.name) if credit.artist.gender else None))
+                for credit in rec.artist_credit.artists]),
+            beatmaps=[SimpleNamespace(
+                external_id=bm.external_id,
+                external_site=SimpleNamespace(
+                    name=bm.external_site.name,
+                    short_name=bm.external_site.short_name,
+                    url_base=bm.external_site.url_base,
+                    url_suffix=bm.external_site.url_suffix),
+                choreographer=bm.choreographer,
+                date=bm.date,
+                state=bm.state)
+                for bm in rec.beatmaps]),
+        covers=[SimpleNamespace(id=cover["id"],
+                                release=SimpleNamespace(gid=cover["release_gid"], name=cover["release_name"]))
+                for cover in row.covers],
+        rec_licenses=[SimpleNamespace(**license) for license in row.rec_licenses],
+        rel_licenses=[(SimpleNamespace(name=license["release_name"]), SimpleNamespace(url=license["url"]))
+                      for license in row.rel_licenses],
+        artist_perms=[(SimpleNamespace(id=perm["id"], name=perm["name"]), SimpleNamespace(url=perm["url"]))
+                      for perm in row.artist_perms],
+        label_perms=[(SimpleNamespace(name=perm["name"]), SimpleNamespace(url=perm["url"]))
+                     for perm in row.label_perms],
+        links=[(SimpleNamespace(url=link["url"]), SimpleNamespace(link_phrase=link["link_phrase"]))
+               for link in row.links],
+        selfpublish=bool(row.selfpublish))
+
+
+@event.listens_for(sqlalchemy.orm.Session, "after_flush")
+def invalidate_recording_detail(session, flush_context):
+    """Drop cached recording details when one of their beatmaps changes"""
+    for obj in session.new | session.dirty | session.deleted:
+        if not isinstance(obj, Beatmap):
+            continue
+        state = sqlalchemy.inspect(obj)
+        gids = set(state.attrs.recording_gid.history.sum())
+        gids.update(rec.gid for rec in state.attrs.recording.history.sum() if rec is not None)
+        gids.add(obj.recording_gid)
+        for gid in gids:
+            if gid is not None:
+                recording_cache.pop(str(gid))
+
+
+@bp.route("/recording/<uuid:gid>")
+@cache(max_age=1*60, public=True)
+def recording(gid):
+    detail = recording_cache.get(str(gid))
+    if detail is None:
+        detail = load_recording_detail(str(gid))
+        recording_cache.set(str(gid), detail)
+    preload_translations([detail.recording.id], [detail.recording.artist_credit_id])
+    # rotate the covers once a day, without making the page nondeterministic
+    covers = detail.covers
+    if len(covers) > 0:
+        day = date.today().toordinal() % len(covers)
+        covers = covers[day:] + covers[:day]
     return render_template("recording.html",
-                           recording=rec,
+                           recording=detail.recording,
                            covers=covers,
-                           rec_licenses=rec_licenses,
-                           rel_licenses=rel_licenses,
-                           artist_perms=artist_perms,
-                           label_perms=label_perms,
-                           links=links,
+                           rec_licenses=detail.rec_licenses,
+                           rel_licenses=detail.rel_licenses,
+                           artist_perms=detail.artist_perms,
+                           label_perms=detail.label_perms,
+                           links=detail.links,
                            State=Beatmap.State,
-                           selfpublish=selfpublish)
+                           selfpublish=detail.selfpublish)
 
 
 @bp.route("/beatmap/<sitename>/<extid>", methods={'GET', 'POST'})
@@ -378,11 +573,11 @@ def beatmap(sitename, extid):
             Beatmap.external_id == extid).one()
     except sqlalchemy.orm.exc.NoResultFound:
         from musicgamez.main.tasks import fetch_single
-        from urllib.error import URLError
+        from requests import RequestException
         bm = None
         try:
             bm = fetch_single(site, db.session, extid)
-        except URLError:
+        except RequestException:
             pass
         if bm is None:
             raise
@@ -0,0 +1,60 @@
+from difflib import SequenceMatcher
+import hashlib
+import re
+import unicodedata
+
+
+# "Song (feat. Someone)", "Artist ft. Someone", "Artist featuring Someone":
+# everything from the featuring credit on is dropped. It has to follow
+# something, so a title that starts with "Feat" is left alone.
+FEATURING = re.compile(r"(?<=\S)\s*[\(\[]?\s*\b(?:feat|ft|featuring)\b\.?\s.*$", re.IGNORECASE)
+
+# The key of a title and the key of an artist are joined with a character
+# that name_key always strips, so the pair can't be ambiguous
+SEPARATOR = "\x1f"
+
+
+def name_key(name):
+    """Normalize a name for matching: NFKC, casefolded, without a featuring
+    credit, and with punctuation, symbols and whitespace removed, so that
+    "Song (feat. X)", "SONG" and "Ｓｏｎｇ!" all have the same key"""
+    name = unicodedata.normalize("NFKC", name).casefold()
+    stripped = FEATURING.sub("", name)
+    key = "".join(c for c in stripped if unicodedata.category(c)[0] not in "PSZC")
+    if key == "":
+        # names like "!!!" are nothing but punctuation
+        key = "".join(c for c in name if not c.isspace())
+    return key
+
+
+def match_key(title, artist):
+    return name_key(title) + SEPARATOR + name_key(artist)
+
+
+def match_keys(titles, artists):
+    """Every combination of the title and artist names a recording is known
+    by, as match keys"""
+    title_keys = {name_key(title) for title in titles if title}
+    artist_keys = {name_key(artist) for artist in artists if artist}
+    return {title_key + SEPARATOR + artist_key
+            for title_key in title_keys
+            for artist_key in artist_keys}
+
+
+def key_digest(key):
+    """A fixed-size stand-in for a match key, to store and index"""
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def similarity(key, keys):
+    """How close a name key is to the closest of keys, from 0 to 1"""
+    return max((SequenceMatcher(None, key, other).ratio() for other in keys), default=0)
+
+
+def string_similarity(title, artist, titles, artists):
+    """How similar a beatmap's title and artist are to the closest of the
+    titles and artists a recording is known by, from 0 to 1. The title
+    counts a bit more than the artist, since beatmap artist fields are often
+    a mess of featured artists and romanizations."""
+    return (0.6 * similarity(name_key(title), {name_key(name) for name in titles if name}) +
+            0.4 * similarity(name_key(artist), {name_key(name) for name in artists if name}))
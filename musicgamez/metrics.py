@@ -0,0 +1,156 @@
+from bisect import bisect_left
+from flask import abort, g, has_request_context, request
+import hmac
+from jinja2 import Template
+import logging
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from threading import Lock
+import time
+
+
+logger = logging.getLogger(__name__)
+
+SECONDS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNTS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BYTES = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# only keep this many statements per request for the slow request log
+MAX_LOGGED_STATEMENTS = 100
+
+
+class Histogram(object):
+    """A Prometheus-style histogram, with one series per endpoint"""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+        self._lock = Lock()
+
+    def observe(self, endpoint, value):
+        with self._lock:
+            if endpoint not in self.series:
+                self.series[endpoint] = [[0] * (len(self.buckets) + 1), 0]
+            counts, total = self.series[endpoint]
+            counts[bisect_left(self.buckets, value)] += 1
+            self.series[endpoint][1] = total + value
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} histogram".format(self.name)]
+        with self._lock:
+            series = [(endpoint, list(counts), total) for endpoint, (counts, total) in sorted(self.series.items())]
+        for endpoint, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(self.name, endpoint, bound, cumulative))
+            lines.append('{}_sum{{endpoint="{}"}} {}'.format(self.name, endpoint, total))
+            lines.append('{}_count{{endpoint="{}"}} {}'.format(self.name, endpoint, cumulative))
+        return lines
+
+
+class TimedTemplate(Template):
+    """A template that adds the time spent rendering it to the request"""
+
+    def render(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            if has_request_context():
+                g.render_time = g.get("render_time", 0) + time.perf_counter() - start
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+    if not has_request_context():
+        return
+    g.sql_count = g.get("sql_count", 0) + 1
+    g.sql_time = g.get("sql_time", 0) + elapsed
+    statements = g.setdefault("sql_statements", [])
+    if len(statements) < MAX_LOGGED_STATEMENTS:
+        statements.append((elapsed, statement))
+
+
+class Metrics(object):
+    """Per-endpoint request, SQL and render timings, exposed in the
+    Prometheus text format on /metrics to scrapers with METRICS_TOKEN"""
+
+    def __init__(self):
+        self.duration = Histogram("musicgamez_request_duration_seconds",
+            "Time spent handling requests", SECONDS)
+        self.sql_time = Histogram("musicgamez_request_sql_seconds",
+            "Time spent in SQL statements per request", SECONDS)
+        self.sql_count = Histogram("musicgamez_request_sql_statements",
+            "Number of SQL statements per request", COUNTS)
+        self.render_time = Histogram("musicgamez_request_render_seconds",
+            "Time spent rendering templates per request", SECONDS)
+        self.response_size = Histogram("musicgamez_response_size_bytes",
+            "Size of response bodies", BYTES)
+        self.stats = {}
+
+    def init_app(self, app):
+        self.slow_request_threshold = app.config["SLOW_REQUEST_THRESHOLD"]
+        self.token = app.config["METRICS_TOKEN"]
+        if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        app.jinja_env.template_class = TimedTemplate
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.add_url_rule("/metrics", "metrics", self.expose)
+
+    def register_stats(self, name, stats):
+        """Also expose the counters in the dict returned by stats()"""
+        self.stats[name] = stats
+
+    def start_request(self):
+        g.metrics_start_time = time.perf_counter()
+
+    def finish_request(self, response):
+        if "metrics_start_time" not in g:
+            return response
+        duration = time.perf_counter() - g.metrics_start_time
+        endpoint = request.endpoint or "none"
+        self.duration.observe(endpoint, duration)
+        self.sql_time.observe(endpoint, g.get("sql_time", 0))
+        self.sql_count.observe(endpoint, g.get("sql_count", 0))
+        self.render_time.observe(endpoint, g.get("render_time", 0))
+        if not response.is_streamed:
+            self.response_size.observe(endpoint, response.calculate_content_length() or 0)
+        if duration > self.slow_request_threshold:
+            logger.warning("Slow request {} {} took {:.3f}s, {} statements in {:.3f}s, rendering {:.3f}s:\n{}".format(
+                request.method, request.full_path, duration,
+                g.get("sql_count", 0), g.get("sql_time", 0), g.get("render_time", 0),
+                "\n".join("{:.3f}s {}".format(elapsed, statement)
+                          for elapsed, statement in g.get("sql_statements", []))))
+        return response
+
+    def authorized(self):
+        """Whether the request has the metrics token. The site is behind a
+        reverse proxy, so the peer address is always the proxy's and says
+        nothing about who is asking."""
+        if not self.token:
+            return False
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), self.token.encode())
+
+    def expose(self):
+        if not self.authorized():
+            abort(404)
+        lines = []
+        for histogram in (self.duration, self.sql_time, self.sql_count,
+                          self.render_time, self.response_size):
+            lines.extend(histogram.expose())
+        for name, stats in sorted(self.stats.items()):
+            for key, value in sorted(stats().items()):
+                lines.append("# TYPE musicgamez_{}_{} gauge".format(name, key))
+                lines.append("musicgamez_{}_{} {}".format(name, key, value))
+        return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4"}
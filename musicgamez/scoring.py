@@ -0,0 +1,65 @@
+import numpy as np
+
+
+# Durations further apart than this all count as equally far
+MAX_DURATION_DELTA = 30.0
+# Recordings on this many tracks or more all count as equally popular
+MAX_TRACK_COUNT = 1000
+
+DEFAULT_WEIGHTS = {
+    # how much each part of the score counts
+    "similarity": 1.0,
+    "duration": 0.1,
+    "popularity": 0.02,
+}
+
+# How much the duration counts on each site, relative to the duration weight.
+# osu! lengths are drain times, and a lot of maps are of a TV size cut, so
+# the length there says little about which recording it is.
+DEFAULT_SITE_DURATION_WEIGHTS = {
+    "bs": 1.0,
+    "osu": 0.3,
+}
+
+
+def score_candidates(similarity, duration_delta, track_count, site_weight,
+                     weights=DEFAULT_WEIGHTS):
+    """Score every candidate recording of a batch of beatmaps at once.
+
+    All arguments are arrays with one entry per candidate: how similar its
+    names are to the beatmap's (0 to 1), the difference in seconds between
+    their lengths (NaN when either is unknown, which is penalized like
+    lengths MAX_DURATION_DELTA apart), the number of tracks it is on, and the
+    weight of the duration on the beatmap's site. Higher scores are better."""
+    similarity = np.asarray(similarity, dtype=np.float64)
+    duration_delta = np.abs(np.asarray(duration_delta, dtype=np.float64))
+    duration_penalty = np.where(
+        np.isnan(duration_delta), 1.0,
+        np.minimum(duration_delta, MAX_DURATION_DELTA) / MAX_DURATION_DELTA)
+    popularity = np.minimum(
+        np.log1p(np.asarray(track_count, dtype=np.float64)) / np.log1p(MAX_TRACK_COUNT), 1)
+    return (weights["similarity"] * similarity
+            - weights["duration"] * np.asarray(site_weight, dtype=np.float64) * duration_penalty
+            + weights["popularity"] * popularity)
+
+
+def best_candidates(groups, scores):
+    """Pick the best candidate of each beatmap.
+
+    groups is an array of which beatmap each candidate belongs to. Returns
+    the beatmaps that have candidates, the index of the best candidate of
+    each, its score, and the margin over the second best (infinite when
+    there is only one), which tells how ambiguous the match is."""
+    groups = np.asarray(groups)
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(groups) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([]), np.array([])
+    # by beatmap, then best score first
+    order = np.lexsort((-scores, groups))
+    sorted_groups = groups[order]
+    sorted_scores = scores[order]
+    beatmaps, starts, counts = np.unique(sorted_groups, return_index=True, return_counts=True)
+    best = sorted_scores[starts]
+    second = np.where(counts > 1, sorted_scores[np.minimum(starts + 1, len(order) - 1)], -np.inf)
+    return beatmaps, order[starts], best, best - second
@@ -1,10 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import mbdata
 import mbdata.search
 from mbdata.search import Entity, Field, CustomArtist
 from mbdata.models import Artist, ArtistCredit, ArtistCreditName, Recording
+import re
+import requests
 from sqlalchemy.orm import relationship, backref
 from lxml import etree as ET
 
+
+logger = logging.getLogger(__name__)
+
 # mbdata includes integration with Solr, a search engine. Which is nice!
 # Unfortunately, the way it sets up the search index is not very useful to us.
 # For example, we don't need to search any tables other than Recording. Again
@@ -24,7 +31,8 @@ class CustomArtistCreditName(ArtistCreditName):
 
 class CustomRecording(Recording):
     redirect_gids = relationship("RecordingGIDRedirect")
-    tracks = relationship("Track")
+    # tracks comes from the backref of Track.recording, which can't be
+    # declared again here
     artist_credit = relationship(CustomArtistCredit, foreign_keys=[Recording.artist_credit_id], innerjoin=True)
     aliases = relationship("RecordingAlias")
 
@@ -79,3 +87,51 @@ SEARCH_SCHEMA_XML = """<schema name="musicbrainz" version="1.1">
 # to start:
 # /usr/lib/jvm/java-1.8.0-openjdk-amd64/bin/java -Dsolr.solr.home=<mbdata_solr> -jar start.jar
 
+
+SOLR_SPECIAL = re.compile(r'([+\-&|!(){}\[\]^"~*?:\\/])')
+
+
+def solr_terms(text):
+    """Escape text for a Solr query, as a list of terms to be ORed"""
+    # the analyzer lowercases anyway, and this keeps words like "AND" from
+    # being read as operators
+    return " ".join(SOLR_SPECIAL.sub(r"\\\1", word) for word in text.lower().split())
+
+
+def recording_query(title, artist, duration=None, tolerance=10000):
+    """Solr parameters for recordings named like title by artists named like
+    artist, within tolerance milliseconds of duration seconds. None if there
+    is nothing to search for."""
+    title = solr_terms(title)
+    artist = solr_terms(artist)
+    if title == "" or artist == "":
+        return None
+    params = {"q": "name:({}) AND artist:({})".format(title, artist),
+              "fq": ["kind:recording"],
+              "fl": "id,score",
+              "wt": "json"}
+    if duration:
+        params["fq"].append("dur:[{} TO {}]".format(
+            int(duration * 1000 - tolerance), int(duration * 1000 + tolerance)))
+    return params
+
+
+def search_recordings(client, uri, queries, rows=10, concurrency=4):
+    """Run recording queries against the Solr core at uri, several at a time
+    over client's pooled connections. Returns the ids of the top rows
+    recordings for each query, or an empty list for queries that were None
+    or failed."""
+    def search(params):
+        if params is None:
+            return []
+        try:
+            docs = client.get_json(uri.rstrip("/") + "/select",
+                                   params=dict(params, rows=rows))["response"]["docs"]
+        except requests.RequestException as e:
+            logger.warning("Solr query {!r} failed: {}".format(params["q"], e))
+            return []
+        # documents are identified as "recording:<id>"
+        return [int(doc["id"].rsplit(":", 1)[-1]) for doc in docs]
+
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="solr") as executor:
+        return list(executor.map(search, queries))
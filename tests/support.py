@@ -0,0 +1,125 @@
+"""Setup shared by the tests.
+
+The app can only be created once per process, since its scheduler can't be
+started again after a shutdown, so every test uses the same one. Tests that
+need a database get it from MUSICGAMEZ_TEST_DATABASE_URI and are skipped
+without one. It has to be a scratch PostgreSQL database: setup_database
+drops everything in it."""
+import os
+import unittest
+
+DATABASE_URI = os.environ.get("MUSICGAMEZ_TEST_DATABASE_URI")
+
+needs_database = unittest.skipIf(DATABASE_URI is None, "MUSICGAMEZ_TEST_DATABASE_URI is not set")
+
+_app = None
+
+
+def get_app():
+    global _app
+    if _app is None:
+        from musicgamez import create_app
+        _app = create_app({
+            "TESTING": True,
+            # keeps the scheduler's jobs in memory, out of the database
+            "DEBUG": True,
+            "SQLALCHEMY_DATABASE_URI": DATABASE_URI or "sqlite://",
+        })
+    return _app
+
+
+# The sample data that setup_database writes
+ARTIST_GID = "00000000-0000-4000-8000-000000000001"
+RECORDING_GID = "00000000-0000-4000-8000-000000000002"
+UNDATED_RECORDING_GID = "00000000-0000-4000-8000-000000000003"
+RELEASE_GID = "00000000-0000-4000-8000-000000000004"
+RELEASE_GROUP_GID = "00000000-0000-4000-8000-000000000005"
+LABEL_GID = "00000000-0000-4000-8000-000000000006"
+TAG = "electronic"
+ARTIST_ALIAS = "Alias Artist"
+RECORDING_ALIAS = "Alias Song"
+
+_database_ready = False
+
+
+def setup_database():
+    """Create the MusicBrainz tables and the app's tables and views in the
+    test database, which is emptied first, and add two recordings by an
+    artist with an alias, on a tagged and labelled release, each with a
+    Beat Saber map. Only the first has a map with a date. Done once per
+    process."""
+    global _database_ready
+    if _database_ready:
+        return
+    from datetime import datetime
+    import mbdata.models as mb
+    from musicgamez import db, ARTIST_NAME_ALIAS_TYPE, RECORDING_NAME_ALIAS_TYPE
+    from musicgamez.main.models import Beatmap, BeatSite
+
+    with get_app().app_context():
+        engine = db.engine
+        schemas = {table.schema for table in mb.Base.metadata.tables.values()} - {None}
+        for schema in schemas | {"public"}:
+            engine.execute('DROP SCHEMA IF EXISTS "{0}" CASCADE; CREATE SCHEMA "{0}"'.format(schema))
+        # medium_index needs the cube extension, and nothing here uses it
+        mb.Base.metadata.create_all(engine, tables=[
+            table for table in mb.Base.metadata.sorted_tables if table.name != "medium_index"])
+        db.create_all()
+
+        session = db.session
+        session.add_all([
+            mb.ArtistAliasType(id=1, name="Artist name", gid=ARTIST_NAME_ALIAS_TYPE),
+            mb.RecordingAliasType(id=1, name="Recording name", gid=RECORDING_NAME_ALIAS_TYPE),
+            mb.Artist(id=1, gid=ARTIST_GID, name="Artist", sort_name="Artist"),
+            mb.ArtistCredit(id=1, name="Artist", artist_count=1),
+            mb.Label(id=1, gid=LABEL_GID, name="Label"),
+            mb.Tag(id=1, name=TAG),
+        ])
+        session.flush()
+        session.add_all([
+            mb.ArtistAlias(id=1, artist_id=1, name=ARTIST_ALIAS, sort_name=ARTIST_ALIAS,
+                           locale="en", primary_for_locale=True, type_id=1),
+            mb.ArtistCreditName(artist_credit_id=1, position=0, artist_id=1, name="Artist", join_phrase=""),
+            mb.ReleaseGroup(id=1, gid=RELEASE_GROUP_GID, name="Album", artist_credit_id=1),
+            mb.Recording(id=1, gid=RECORDING_GID, name="Song", artist_credit_id=1, length=200000),
+            mb.Recording(id=2, gid=UNDATED_RECORDING_GID, name="Undated Song", artist_credit_id=1, length=180000),
+        ])
+        session.flush()
+        session.add_all([
+            mb.RecordingAlias(id=1, recording_id=1, name=RECORDING_ALIAS, sort_name=RECORDING_ALIAS,
+                              locale="en", primary_for_locale=True, type_id=1),
+            mb.Release(id=1, gid=RELEASE_GID, name="Album", artist_credit_id=1, release_group_id=1),
+        ])
+        session.flush()
+        session.add_all([
+            mb.Medium(id=1, release_id=1, position=1),
+            mb.ReleaseTag(release_id=1, tag_id=1, count=1),
+            mb.ReleaseLabel(id=1, release_id=1, label_id=1),
+        ])
+        session.flush()
+        site = session.query(BeatSite).filter(BeatSite.short_name == "bs").one()
+        session.add_all([
+            mb.Track(id=1, gid="00000000-0000-4000-8000-000000000011", recording_id=1, medium_id=1,
+                     position=1, number="1", name="Song", artist_credit_id=1),
+            mb.Track(id=2, gid="00000000-0000-4000-8000-000000000012", recording_id=2, medium_id=1,
+                     position=2, number="2", name="Undated Song", artist_credit_id=1),
+            Beatmap(artist="Artist", title="Song", external_id="1", external_site=site,
+                    choreographer="Mapper", date=datetime(2021, 1, 1), duration=200,
+                    recording_gid=RECORDING_GID, state=Beatmap.State.MATCHED_WITH_STRING),
+            Beatmap(artist="Artist", title="Undated Song", external_id="2", external_site=site,
+                    choreographer="Mapper", duration=180,
+                    recording_gid=UNDATED_RECORDING_GID, state=Beatmap.State.MATCHED_WITH_STRING),
+        ])
+        session.commit()
+        refresh_views()
+    _database_ready = True
+
+
+def refresh_views():
+    from musicgamez import db
+    # in the order they were created, so views come after the ones they use
+    for view, in db.session.execute(
+            "SELECT relname FROM pg_class WHERE relkind = 'm' "
+            "AND relnamespace = 'public'::regnamespace ORDER BY oid").fetchall():
+        db.session.execute('REFRESH MATERIALIZED VIEW "{}"'.format(view))
+    db.session.commit()
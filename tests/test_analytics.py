@@ -0,0 +1,130 @@
+"""The analytics reporter, posting to a stand-in for Google Analytics"""
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+from musicgamez.analytics import BATCH_SIZE, Reporter
+
+
+class StubApp(object):
+
+    def __init__(self, **config):
+        self.config = dict(GOOGLE_ANALYTICS_TRACKING_ID="UA-0-0",
+                           GOOGLE_ANALYTICS_URI="https://analytics.example.com/batch",
+                           USER_AGENT="musicgamez tests",
+                           ANALYTICS_BUFFER_SIZE=100,
+                           # long enough that only the tests flush
+                           ANALYTICS_INTERVAL=3600,
+                           ANALYTICS_CONCURRENCY=2,
+                           ANALYTICS_RETRIES=0)
+        self.config.update(config)
+
+
+class StubResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+
+class StubHTTP(object):
+    """Answers posts with the given status codes in turn, then 200"""
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.posts = []
+        self._lock = threading.Lock()
+
+    def post(self, url, data=None, **kwargs):
+        with self._lock:
+            self.posts.append(data)
+            status = self.statuses.pop(0) if self.statuses else 200
+        return StubResponse(status)
+
+
+def hit(path):
+    return dict(path=path, host="musicgamez.example.com", url="https://musicgamez.example.com" + path,
+                language="en", referrer=None, user_agent="Browser", accept="text/html",
+                accept_language="en", remote_addr="192.0.2.1", dnt=False, srt="10")
+
+
+class ReporterTest(unittest.TestCase):
+
+    def reporter(self, http, **config):
+        reporter = Reporter(http)
+        # the atexit handler is what shuts it down outside the tests
+        with mock.patch("musicgamez.analytics.atexit.register") as register:
+            reporter.init_app(StubApp(**config))
+        register.assert_called_once_with(reporter.shutdown)
+        self.addCleanup(reporter.shutdown)
+        return reporter
+
+    def test_flush(self):
+        http = StubHTTP()
+        reporter = self.reporter(http)
+        for i in range(BATCH_SIZE + 1):
+            reporter.record(**hit("/recording/{}".format(i)))
+        reporter.flush()
+        self.assertEqual(sorted(len(data.split("\r\n")) for data in http.posts), [1, BATCH_SIZE])
+        self.assertIn("tid=UA-0-0", http.posts[0])
+        self.assertEqual(reporter.stats(), {"buffered": 0, "dropped": 0,
+                                            "sent": BATCH_SIZE + 1, "failed": 0})
+
+    def test_drop_on_full(self):
+        http = StubHTTP()
+        reporter = self.reporter(http, ANALYTICS_BUFFER_SIZE=3)
+        for i in range(5):
+            reporter.record(**hit("/recording/{}".format(i)))
+        self.assertEqual(reporter.stats()["buffered"], 3)
+        self.assertEqual(reporter.stats()["dropped"], 2)
+        reporter.flush()
+        # the oldest were dropped
+        self.assertNotIn("recording%2F0", http.posts[0])
+        self.assertIn("recording%2F4", http.posts[0])
+        self.assertEqual(reporter.stats()["sent"], 3)
+
+    def test_retry(self):
+        http = StubHTTP(503, 503)
+        reporter = self.reporter(http, ANALYTICS_RETRIES=2)
+        reporter.record(**hit("/latest"))
+        with mock.patch("musicgamez.analytics.time.sleep") as sleep:
+            reporter.flush()
+        self.assertEqual(len(http.posts), 3)
+        self.assertEqual(sleep.call_count, 2)
+        # full jitter, up to 2 ** attempt seconds
+        self.assertLessEqual(sleep.call_args_list[1][0][0], 2)
+        self.assertEqual(reporter.stats()["sent"], 1)
+
+    def test_give_up(self):
+        http = StubHTTP(503, 503)
+        reporter = self.reporter(http, ANALYTICS_RETRIES=1)
+        reporter.record(**hit("/latest"))
+        with mock.patch("musicgamez.analytics.time.sleep"):
+            reporter.flush()
+        self.assertEqual(reporter.stats()["failed"], 1)
+        self.assertEqual(reporter.stats()["sent"], 0)
+
+    def test_shutdown(self):
+        # what is still buffered at exit is sent
+        http = StubHTTP()
+        reporter = self.reporter(http)
+        reporter.record(**hit("/latest"))
+        reporter.shutdown()
+        self.assertEqual(len(http.posts), 1)
+        self.assertEqual(reporter.stats()["sent"], 1)
+
+    def test_disabled(self):
+        http = StubHTTP()
+        reporter = Reporter(http)
+        reporter.init_app(StubApp(GOOGLE_ANALYTICS_TRACKING_ID=None))
+        reporter.record(**hit("/latest"))
+        self.assertEqual(reporter.stats()["buffered"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
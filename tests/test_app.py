@@ -0,0 +1,26 @@
+"""The app and its models load, without needing a database"""
+import unittest
+
+import sqlalchemy.orm
+
+from tests.support import get_app
+
+
+class AppTest(unittest.TestCase):
+
+    def test_create_app(self):
+        self.assertIn("main", get_app().blueprints)
+
+    def test_mappers(self):
+        # the web app imports the tasks before its first query, and with
+        # them the mappers of the search schema
+        get_app()
+        from musicgamez.main import models, tasks
+        from musicgamez.search import CustomRecording
+        sqlalchemy.orm.configure_mappers()
+        self.assertIn("rank", models.RecordingCoverView.__table__.c)
+        self.assertIn("tracks", CustomRecording.__mapper__.relationships)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""The HTTP client's conditional GET cache"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from musicgamez.httpclient import ResponseCache
+
+
+class StubResponse(object):
+
+    def __init__(self, content, headers):
+        self.content = content
+        self.headers = headers
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    URL = "https://example.com/sheet.csv"
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.cache = ResponseCache()
+        self.cache.configure(self.path, 1024)
+
+    def test_validators(self):
+        self.assertEqual(self.cache.validators(self.URL), {})
+        self.cache.store(self.URL, StubResponse(b"a,b\n" * 100, {
+            "ETag": '"1"', "Last-Modified": "Fri, 01 Jan 2021 00:00:00 GMT"}))
+        self.assertEqual(self.cache.validators(self.URL), {
+            "If-None-Match": '"1"', "If-Modified-Since": "Fri, 01 Jan 2021 00:00:00 GMT"})
+        self.cache.not_modified(self.URL)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["bytes_saved"]), (1, 1, 400))
+        # only the validators are kept
+        self.assertEqual([name[-5:] for name in os.listdir(self.path)], [".json"])
+
+    def test_no_validators(self):
+        self.cache.store(self.URL, StubResponse(b"", {"ETag": '"1"'}))
+        self.cache.store(self.URL, StubResponse(b"", {}))
+        self.assertEqual(self.cache.validators(self.URL), {})
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_evict(self):
+        for i in range(20):
+            self.cache.store("{}?page={}".format(self.URL, i), StubResponse(b"", {"ETag": '"1"'}))
+        self.assertLessEqual(self.cache.stats()["size"], 1024)
+        self.assertGreater(self.cache.stats()["evictions"], 0)
+        # the latest one is kept
+        self.assertIn("If-None-Match", self.cache.validators("{}?page=19".format(self.URL)))
+
+
+if __name__ == "__main__":
+    unittest.main()
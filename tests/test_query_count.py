@@ -0,0 +1,45 @@
+"""Recording list pages load a whole page with a fixed number of statements,
+see musicgamez.main.models.recordinglist_options"""
+import unittest
+
+from sqlalchemy import event
+
+from tests.support import get_app, needs_database, setup_database
+
+# keyset pagination, the selectin loads of credits, artists and beatmaps,
+# the alias lookups and a few for the page around the list
+MAX_STATEMENTS = 15
+
+
+@needs_database
+class QueryCountTest(unittest.TestCase):
+
+    def setUp(self):
+        from musicgamez import db, page_cache
+        setup_database()
+        self.app = get_app()
+        page_cache.clear()
+        self.db = db
+        self.statements = []
+
+    def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def get(self, path):
+        with self.app.app_context():
+            engine = self.db.engine
+            event.listen(engine, "before_cursor_execute", self.count_statement)
+            try:
+                return self.app.test_client().get(path)
+            finally:
+                event.remove(engine, "before_cursor_execute", self.count_statement)
+
+    def test_latest(self):
+        response = self.get("/latest")
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(self.statements), MAX_STATEMENTS,
+                             "\n".join(self.statements))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,374 @@
+"""Background tasks, with stand-ins for the web services they use"""
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from tests import support
+from tests.support import get_app, needs_database, setup_database
+
+
+def add_beatmaps(prefix, count, **columns):
+    """Add count Beat Saber maps with external IDs starting with prefix,
+    oldest checked first, and return their IDs"""
+    from datetime import datetime, timedelta
+    from musicgamez import db
+    from musicgamez.main.models import Beatmap, BeatSite
+    with get_app().app_context():
+        site = db.session.query(BeatSite).filter(BeatSite.short_name == "bs").one()
+        beatmaps = [Beatmap(artist="Artist", title="Song", choreographer="Mapper",
+                            external_id="{}{}".format(prefix, i), external_site=site,
+                            last_checked=datetime(2021, 1, 1) + timedelta(days=i), **columns)
+                    for i in range(count)]
+        db.session.add_all(beatmaps)
+        db.session.commit()
+        return [bm.id for bm in beatmaps]
+
+
+def delete_beatmaps(prefix):
+    from musicgamez import db
+    from musicgamez.main.models import Beatmap
+    with get_app().app_context():
+        db.session.query(Beatmap).filter(Beatmap.external_id.like(prefix + "%"))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+
+def gametrack(id):
+    return {"id": id, "uploaded": "2021-01-01T00:00:00Z",
+            "metadata": {"songName": "Dump Song " + id, "songSubName": "",
+                         "songAuthorName": "Dump Artist", "levelAuthorName": "Mapper",
+                         "duration": 100}}
+
+
+class StubResponse(object):
+
+    def __init__(self, body, status_code=200, headers=None):
+        self.raw = io.BytesIO(body)
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@needs_database
+class BeatSaberDumpTest(unittest.TestCase):
+
+    LAST_MODIFIED = "Fri, 01 Jan 2021 00:00:00 GMT"
+    DUMP = json.dumps([gametrack("dump-1"), gametrack("dump-2")]).encode("utf-8")
+
+    def setUp(self):
+        setup_database()
+        self.app = get_app()
+        instance_path = self.app.instance_path
+        self.app.instance_path = tempfile.mkdtemp()
+        self.addCleanup(setattr, self.app, "instance_path", instance_path)
+        self.addCleanup(shutil.rmtree, self.app.instance_path)
+        self.addCleanup(delete_beatmaps, "dump-")
+        self.checkpoint_path = os.path.join(self.app.instance_path, "beatsaber-dump.checkpoint")
+        self.requests = []
+
+    def write_checkpoint(self, **validators):
+        from musicgamez.main.tasks import BEATSABER_DUMP_URL
+        # just past the first map
+        offset = self.DUMP.index(b', {"id": "dump-2"')
+        with open(self.checkpoint_path, "w") as checkpoint_file:
+            json.dump(dict(validators, source=BEATSABER_DUMP_URL, offset=offset), checkpoint_file)
+        return offset
+
+    def fetch(self, *responses):
+        from musicgamez.main import tasks
+        responses = list(responses)
+
+        def get(url, headers=None, **kwargs):
+            self.requests.append(headers or {})
+            return responses.pop(0)
+        with mock.patch.object(tasks.http_client, "get", get):
+            tasks.fetch_beatsaber_dump()
+
+    def imported(self):
+        from musicgamez import db
+        from musicgamez.main.models import Beatmap
+        with self.app.app_context():
+            return sorted(id for id, in db.session.query(Beatmap.external_id)
+                                                  .filter(Beatmap.external_id.like("dump-%")))
+
+    def test_resume(self):
+        offset = self.write_checkpoint(last_modified=self.LAST_MODIFIED)
+        self.fetch(StubResponse(self.DUMP[offset:], 206, {"Last-Modified": self.LAST_MODIFIED}))
+        self.assertEqual(self.requests[0]["Range"], "bytes={}-".format(offset))
+        self.assertEqual(self.requests[0]["If-Range"], self.LAST_MODIFIED)
+        self.assertEqual(self.imported(), ["dump-2"])
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def test_changed(self):
+        # the server sends all of the new version
+        self.write_checkpoint(etag='"old"')
+        self.fetch(StubResponse(self.DUMP, 200, {"ETag": '"new"'}))
+        self.assertEqual(self.requests[0]["If-Range"], '"old"')
+        self.assertEqual(self.imported(), ["dump-1", "dump-2"])
+
+    def test_range_of_changed(self):
+        # the server ignores If-Range and sends part of the new version
+        offset = self.write_checkpoint(last_modified=self.LAST_MODIFIED)
+        partial = StubResponse(self.DUMP[offset:], 206, {"Last-Modified": "Sat, 02 Jan 2021 00:00:00 GMT"})
+        self.fetch(partial, StubResponse(self.DUMP, 200))
+        self.assertTrue(partial.closed)
+        self.assertNotIn("Range", self.requests[1])
+        self.assertEqual(self.imported(), ["dump-1", "dump-2"])
+
+    def test_no_validators(self):
+        # a checkpoint that can't tell whether the dump changed
+        self.write_checkpoint()
+        self.fetch(StubResponse(self.DUMP, 200))
+        self.assertNotIn("Range", self.requests[0])
+        self.assertEqual(self.imported(), ["dump-1", "dump-2"])
+
+
+@needs_database
+class ClaimTest(unittest.TestCase):
+
+    def setUp(self):
+        from musicgamez.main.models import Beatmap
+        setup_database()
+        self.app = get_app()
+        self.ids = add_beatmaps("claim-", 3, state=Beatmap.State.HAS_FINGERPRINT)
+        self.addCleanup(delete_beatmaps, "claim-")
+        self.criteria = [Beatmap.external_id.like("claim-%"),
+                         Beatmap.state == Beatmap.State.HAS_FINGERPRINT]
+
+    def claim(self, session):
+        from musicgamez.main.tasks import claim_beatmaps
+        return claim_beatmaps(session, "lookup", 2, *self.criteria)
+
+    def claim_ids(self, session):
+        return [bm.id for bm in self.claim(session)]
+
+    def test_claim(self):
+        from musicgamez import db
+        from musicgamez.main.models import BeatmapClaim
+        from sqlalchemy.sql import func
+        with self.app.app_context():
+            # oldest checked first, and not again while claimed
+            self.assertEqual(self.claim_ids(db.session), self.ids[:2])
+            self.assertEqual(self.claim_ids(db.session), self.ids[2:])
+            self.assertEqual(self.claim_ids(db.session), [])
+            # until the claims expire
+            db.session.query(BeatmapClaim).update(
+                {BeatmapClaim.expires: func.now()}, synchronize_session=False)
+            db.session.commit()
+            self.assertEqual(self.claim_ids(db.session), self.ids[:2])
+
+    def test_drain(self):
+        from musicgamez.main.models import Beatmap
+        from musicgamez.main.tasks import drain, release_claim
+        batches = []
+
+        def process(session, beatmaps):
+            batches.append([bm.id for bm in beatmaps])
+            for bm in beatmaps:
+                bm.state = Beatmap.State.NO_MATCH
+                release_claim(session, bm)
+            session.commit()
+        drain("lookup", self.claim, process)
+        self.assertEqual(batches, [self.ids[:2], self.ids[2:]])
+
+    def test_drain_stop(self):
+        from musicgamez.main.tasks import drain
+        batches = []
+
+        def process(session, beatmaps):
+            # like when the web service is down, leaving them claimed
+            batches.append([bm.id for bm in beatmaps])
+            return False
+        drain("lookup", self.claim, process)
+        self.assertEqual(batches, [self.ids[:2]])
+
+
+class JSONResponse(object):
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
+
+
+def lookup_result(*recording_gids):
+    return [{"id": "track", "score": 1.0,
+             "recordings": [{"id": gid} for gid in recording_gids]}]
+
+
+class LookupFingerprintsTest(unittest.TestCase):
+
+    def lookup(self, body):
+        from musicgamez.main import tasks
+        from musicgamez.main.models import Beatmap
+        beatmaps = [Beatmap(id=i, fingerprint="AQAA", duration=100.5) for i in range(2)]
+        posts = []
+
+        def post(url, data=None, **kwargs):
+            posts.append(data)
+            return JSONResponse(body)
+        with get_app().app_context(), mock.patch.object(tasks.http_client, "post", post):
+            results = tasks.lookup_fingerprints(beatmaps)
+        # both in one request
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(posts[0]["duration.1"], "100")
+        return results
+
+    def test_results(self):
+        result = lookup_result("00000000-0000-4000-8000-000000000099")
+        results = self.lookup({"status": "ok", "fingerprints": [
+            {"index": "1", "results": result},
+            # no results for the first one
+            {"index": "0"}]})
+        self.assertEqual(results, [None, result])
+
+    def test_error(self):
+        from acoustid import WebServiceError
+        with self.assertRaises(WebServiceError) as cm:
+            self.lookup({"status": "error", "error": {"code": 3, "message": "invalid fingerprint"}})
+        self.assertEqual(cm.exception.code, 3)
+
+
+@needs_database
+class ApplyLookupsTest(unittest.TestCase):
+
+    UNKNOWN_GID = "00000000-0000-4000-8000-000000000099"
+
+    def setUp(self):
+        setup_database()
+        self.app = get_app()
+
+    def apply(self, *results):
+        from musicgamez import db
+        from musicgamez.main.models import Beatmap
+        from musicgamez.main.tasks import apply_lookups
+        beatmaps = [Beatmap(id=i) for i in range(len(results))]
+        with self.app.app_context():
+            apply_lookups(db.session, beatmaps, list(results))
+        return beatmaps
+
+    def test_match(self):
+        from musicgamez.main.models import Beatmap
+        bm, = self.apply(lookup_result(support.RECORDING_GID))
+        self.assertEqual(bm.state, Beatmap.State.MATCHED_WITH_FINGERPRINT)
+        self.assertEqual(str(bm.recording_gid), support.RECORDING_GID)
+        self.assertEqual(bm.track_id, "track")
+
+    def test_miss(self):
+        from musicgamez.main.models import Beatmap
+        beatmaps = self.apply([], lookup_result(), lookup_result(self.UNKNOWN_GID),
+                              lookup_result(support.RECORDING_GID, support.UNDATED_RECORDING_GID))
+        self.assertEqual([bm.state for bm in beatmaps], [
+            Beatmap.State.NO_MATCH, Beatmap.State.NO_MATCH, Beatmap.State.NO_MATCH,
+            Beatmap.State.TOO_MANY_MATCHES])
+
+    def test_error(self):
+        # only the beatmaps with bad results are errors
+        from musicgamez.main.models import Beatmap
+        beatmaps = self.apply(None, [{"recordings": [{}]}], lookup_result(support.RECORDING_GID))
+        self.assertEqual([bm.state for bm in beatmaps], [
+            Beatmap.State.ERROR, Beatmap.State.ERROR, Beatmap.State.MATCHED_WITH_FINGERPRINT])
+
+
+@needs_database
+class LookupBeatmapsTest(unittest.TestCase):
+
+    def setUp(self):
+        from musicgamez.main.models import Beatmap
+        setup_database()
+        self.app = get_app()
+        self.ids = add_beatmaps("lookup-", 3, state=Beatmap.State.HAS_FINGERPRINT,
+                                fingerprint="AQAA", duration=100)
+        self.addCleanup(delete_beatmaps, "lookup-")
+
+    def lookup(self, lookup_fingerprints):
+        from musicgamez import db, fingerprint_engine
+        from musicgamez.main import tasks
+        from musicgamez.main.models import Beatmap, BeatmapClaim
+        with self.app.app_context():
+            beatmaps = tasks.claim_beatmaps(db.session, "lookup", 3, Beatmap.external_id.like("lookup-%"))
+            misses = fingerprint_engine.cache["lookup_misses"]
+            with mock.patch.object(tasks, "lookup_fingerprints", lookup_fingerprints):
+                keep_going = tasks.lookup_beatmaps(db.session, beatmaps)
+            self.misses = fingerprint_engine.cache["lookup_misses"] - misses
+            self.claimed = db.session.query(BeatmapClaim)\
+                .filter(BeatmapClaim.beatmap_id.in_(self.ids)).count()
+            self.states = [state for state, in db.session.query(Beatmap.state)
+                                                          .filter(Beatmap.id.in_(self.ids))
+                                                          .order_by(Beatmap.id)]
+        return keep_going
+
+    def test_exception(self):
+        # an unexpected error about one of the beatmaps only fails that one
+        from musicgamez.main.models import Beatmap
+
+        def lookup_fingerprints(beatmaps):
+            if self.ids[1] in [bm.id for bm in beatmaps]:
+                raise KeyError("index")
+            return [[] for bm in beatmaps]
+        self.assertTrue(self.lookup(lookup_fingerprints))
+        self.assertEqual(self.states, [Beatmap.State.NO_MATCH, Beatmap.State.ERROR, Beatmap.State.NO_MATCH])
+        self.assertEqual(self.claimed, 0)
+        self.assertEqual(self.misses, 3)
+
+    def test_unavailable(self):
+        # left claimed to be tried again later
+        import requests
+        from musicgamez.main.models import Beatmap
+
+        def lookup_fingerprints(beatmaps):
+            raise requests.ConnectionError()
+        self.assertFalse(self.lookup(lookup_fingerprints))
+        self.assertEqual(self.states, [Beatmap.State.HAS_FINGERPRINT] * 3)
+        self.assertEqual(self.claimed, 3)
+
+
+@needs_database
+class MatchWithSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        from musicgamez.main.models import Beatmap
+        setup_database()
+        self.app = get_app()
+        self.ids = add_beatmaps("search-", 2, state=Beatmap.State.NO_MATCH, duration=200)
+        self.addCleanup(delete_beatmaps, "search-")
+
+    def test_match(self):
+        from musicgamez import db
+        from musicgamez.main import tasks
+        from musicgamez.main.models import Beatmap
+        queries = []
+
+        def search_recordings(client, uri, batch, **kwargs):
+            queries.extend(batch)
+            # Solr found the first one, and nothing for the second
+            return [[1, 2], []]
+        with self.app.app_context(), mock.patch.object(tasks, "search_recordings", search_recordings):
+            beatmaps = db.session.query(Beatmap).filter(Beatmap.id.in_(self.ids)).order_by(Beatmap.id).all()
+            self.assertEqual(tasks.match_with_search(db.session, beatmaps), 1)
+            db.session.commit()
+            matched = db.session.query(Beatmap.recording_gid, Beatmap.state)\
+                .filter(Beatmap.id.in_(self.ids)).order_by(Beatmap.id).all()
+        self.assertEqual(len(queries), 2)
+        # "Song" by "Artist", and not "Undated Song"
+        self.assertEqual([(str(gid) if gid else None, state) for gid, state in matched], [
+            (support.RECORDING_GID, Beatmap.State.MATCHED_WITH_STRING),
+            (None, Beatmap.State.NO_MATCH)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Pages rendered from a small sample database, see tests.support"""
+import html
+import re
+import unittest
+
+from tests import support
+from tests.support import get_app, needs_database, setup_database
+
+
+@needs_database
+class RecordingListTest(unittest.TestCase):
+
+    def setUp(self):
+        from musicgamez import page_cache
+        setup_database()
+        page_cache.clear()
+        self.client = get_app().test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200, path)
+        return response.get_data(as_text=True)
+
+    def test_aliases(self):
+        page = self.get("/latest")
+        self.assertIn(support.RECORDING_ALIAS, page)
+        self.assertIn(support.ARTIST_ALIAS, page)
+
+    def test_undated(self):
+        # every recording is on a page of its own, and the dated one comes
+        # first
+        app = get_app()
+        perpage = app.config["PERPAGE"]
+        app.config["PERPAGE"] = 1
+        try:
+            first = self.get("/latest")
+            self.assertIn(support.RECORDING_ALIAS, first)
+            next_url = re.search(r'href="([^"]*before=[^"]*)"', first).group(1)
+            second = self.get(html.unescape(next_url))
+            self.assertIn("Undated Song", second)
+            previous_url = re.search(r'href="([^"]*after=[^"]*)"', second).group(1)
+            self.assertIn(support.RECORDING_ALIAS, self.get(html.unescape(previous_url)))
+        finally:
+            app.config["PERPAGE"] = perpage
+
+    def test_numbered_page(self):
+        app = get_app()
+        perpage = app.config["PERPAGE"]
+        app.config["PERPAGE"] = 1
+        try:
+            self.assertIn("Undated Song", self.get("/latest/2"))
+        finally:
+            app.config["PERPAGE"] = perpage
+
+    def test_tag(self):
+        page = self.get("/tag/" + support.TAG)
+        self.assertIn(support.RECORDING_ALIAS, page)
+        self.assertIn("Undated Song", page)
+
+    def test_recording(self):
+        page = self.get("/recording/" + support.RECORDING_GID)
+        self.assertIn(support.RECORDING_ALIAS, page)
+        self.assertIn("Mapper", page)
+
+
+if __name__ == "__main__":
+    unittest.main()